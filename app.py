@@ -1,20 +1,33 @@
-import os
 import asyncio
-from aiogram import Bot, Dispatcher
-from aiogram.enums import ParseMode
+from aiogram import Dispatcher
 from dotenv import load_dotenv, find_dotenv
 from handlers_bot.user_private import user_private_router
+from service.config import EMBEDDED_WORKERS
+from service.metrics import start_metrics_server
+from service.ollama import close_ollama, start_ollama
+from service.telegram import create_bot
+from service.worker import make_worker_id, run_worker
 
 load_dotenv(find_dotenv())
 
-bot = Bot(token=os.getenv('TOKEN'), parse_mode=ParseMode.HTML)
+bot = create_bot()
 
 dp = Dispatcher()
 
 dp.include_router(user_private_router)
 
 async def main():
-    await dp.start_polling(bot)
+    await start_metrics_server()
+    # LLM вызывают только воркеры, без них модель держать в памяти незачем
+    if EMBEDDED_WORKERS:
+        await start_ollama()
+    workers = [asyncio.create_task(run_worker(bot, make_worker_id(i))) for i in range(EMBEDDED_WORKERS)]
+    try:
+        await dp.start_polling(bot)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await close_ollama()
 
 
 asyncio.run(main())
\ No newline at end of file
@@ -1,11 +1,16 @@
 import os
+import time
+
 from aiogram import Router, types, F
-from aiogram.filters import CommandStart
+from aiogram.filters import CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from service.ollama import assembly_request
-from service.parser import process_video_with_ffmpeg
+from service.config import PREVIEW_FIRST
+from service.jobs import enqueue_job, get_job
+from service.metrics import span
+from service.sources import download_source, get_source, remember_source
+from service.telegram import fetch_video
 
 
 user_private_router = Router()
@@ -22,21 +27,28 @@ async def start(message: types.Message, state: FSMContext):
     await state.set_state(WaitData.video)
 
 
-@user_private_router.message(WaitData.video, F.video)
+# новое видео можно прислать и после монтажа, вместо очередного описания
+@user_private_router.message(StateFilter(WaitData.video, WaitData.promt), F.video)
 async def video_user(message: types.Message, state: FSMContext):
     video = message.video
 
-    # Получаем путь к файлу на серверах Telegram
-    video_file_info = await message.bot.get_file(video.file_id)
-
-    # Формируем путь для сохранения
-    video_file_path = video_file_info.file_path
-    video_filename = f'downloads_video/video_{video.file_unique_id}.mp4'
+    # это видео уже скачивали, берём его из кеша исходников
+    video_filename = await get_source(video.file_unique_id)
+    download = None
 
-    await message.bot.download_file(video_file_path, video_filename)
+    if video_filename is None:
+        # с локальным Bot API файл берётся с диска сервера, иначе скачивается
+        started = time.time()
+        with span('telegram_download', size=video.file_size):
+            video_filename = await download_source(
+                video.file_unique_id,
+                lambda path: fetch_video(message.bot, video.file_id, path)
+            )
+        # скачивание идёт до постановки задачи: время сохраняется в задаче и попадает в её трейс
+        download = (started, time.time() - started)
 
     await message.answer('Видео получено и скачено\nОтправьте описание монтажа и что нужно сделать')
-    await state.update_data(video_path=video_filename)
+    await state.update_data(video_path=video_filename, file_key=video.file_unique_id, download=download)
     await state.set_state(WaitData.promt)
 
 
@@ -45,30 +57,50 @@ async def promt_user(message: types.Message, state: FSMContext):
     data = await state.get_data()
     promt = message.text
     video_path = data.get("video_path")
-    
-    command = await assembly_request(promt)
-    await message.answer('супер, мы получили и проанализировали ваше описание, сейчас работаем над монтажем видео..')
-    try:
-        result_files = await process_video_with_ffmpeg(video_path, command)
-        
-        if result_files and not isinstance(result_files[0], str):
-            for file_path in result_files:
-                if os.path.exists(file_path):
-                    with open(file_path, 'rb') as video_file:
-                        await message.answer_video(
-                            types.BufferedInputFile(
-                                video_file.read(),
-                                filename=os.path.basename(file_path)
-                            ),
-                            caption=f"Часть видео"
-                        )
-                        os.remove(file_path)
-        else:
-            await message.answer(f"Ошибка: {result_files[0] if result_files else 'Неизвестная ошибка'}")
-            
-    except Exception as e:
-        await message.answer(f"Произошла ошибка: {str(e)}")
-    
-    await state.clear()
-    await message.answer('Обработка завершена!')
-    os.remove(video_path)
+    file_key = data.get("file_key")
+    # скачивание относится только к первой задаче по этому видео
+    download = data.get("download")
+    await state.update_data(download=None)
+
+    if not video_path or not os.path.exists(video_path):
+        # исходник вытеснен из кеша, пока пользователь думал над следующим монтажом
+        await message.answer('Видео больше нет на сервере, отправьте его ещё раз')
+        await state.set_state(WaitData.video)
+        return
+
+    # "/preview описание" - сначала быстрое превью, "/full описание" - сразу полный рендер
+    preview = PREVIEW_FIRST
+    command, _, rest = promt.partition(' ')
+    if command in ('/preview', '/full') and rest.strip():
+        preview = command == '/preview'
+        promt = rest.strip()
+
+    if file_key:
+        await remember_source(file_key, video_path)
+
+    # монтаж делают воркеры из очереди, результат они отправят в этот чат сами
+    await enqueue_job(message.chat.id, video_path, promt, file_key=file_key, preview=preview, download=download)
+    await message.answer(
+        ('Задача поставлена в очередь, пришлём превью, как только оно будет готово\n' if preview else
+         'Задача поставлена в очередь, пришлём видео, как только оно будет готово\n') +
+        'Можно сразу прислать ещё одно описание для этого же видео или новое видео'
+    )
+
+
+@user_private_router.callback_query(F.data.startswith('full:'))
+async def full_render(callback: types.CallbackQuery):
+    job = await get_job(int(callback.data.split(':', 1)[1]))
+
+    if job is None or job['chat_id'] != callback.message.chat.id or not job['plan']:
+        await callback.answer('Задача не найдена')
+        return
+
+    if not os.path.exists(job['video_path']):
+        await callback.answer()
+        await callback.message.answer('Видео больше нет на сервере, отправьте его ещё раз')
+        return
+
+    # план берём из задачи превью, повторно к LLM не обращаемся
+    await enqueue_job(job['chat_id'], job['video_path'], job['prompt'], file_key=job['file_key'], plan=job['plan'])
+    await callback.answer('Запустили рендер в полном качестве')
+    await callback.message.edit_reply_markup(reply_markup=None)
@@ -0,0 +1,27 @@
+import sys
+import asyncio
+from service.metrics import start_metrics_server
+from service.ollama import close_ollama, start_ollama
+from service.telegram import create_bot
+from service.worker import make_worker_id, run_worker
+
+# Отдельный процесс рендера: python render_worker.py [число воркеров]
+# Можно запускать несколько штук на той же машине, что и бот: очередь в SQLite (JOBS_DB, режим WAL)
+# работает только на локальном диске одного хоста, не на сетевой файловой системе
+# Каждому процессу нужен свой METRICS_PORT
+
+bot = create_bot()
+
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    await start_metrics_server()
+    await start_ollama()
+    try:
+        await asyncio.gather(*[run_worker(bot, make_worker_id(i)) for i in range(count)])
+    finally:
+        await close_ollama()
+        await bot.session.close()
+
+
+asyncio.run(main())
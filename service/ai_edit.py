@@ -1,8 +1,16 @@
 import asyncio
+import hashlib
+import os
 import aiohttp
 from pathlib import Path
 from runwayml import AsyncRunwayML
 
+from service.cache import SingleFlight, evict_files, link_or_copy
+from service.config import CACHE_DIR, RUNWAY_CACHE_MAX_BYTES
+from service.metrics import inc
+from service.probe import file_sha256, probe_media
+from service.proxy import runway_proxy
+
 
 
 ALLOWED_RATIOS = [
@@ -18,24 +26,12 @@ ALLOWED_RATIOS = [
 
 
 async def get_video_resolution_async(file_path: str) -> tuple[int, int]:
-    process = await asyncio.create_subprocess_exec(
-        "ffprobe",
-        "-v", "error",
-        "-select_streams", "v:0",
-        "-show_entries", "stream=width,height",
-        "-of", "csv=p=0",
-        file_path,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
-
-    stdout, stderr = await process.communicate()
-
-    if process.returncode != 0:
-        raise RuntimeError(f'ошибка ффмпег при получении разрешения видео: {stderr.decode()}')
-    
-    width, height = map(int, stdout.decode().strip().split(','))
-    return width, height
+    info = await probe_media(file_path)
+
+    if not info.get('width') or not info.get('height'):
+        raise RuntimeError(f'ошибка ффмпег при получении разрешения видео: нет видеопотока в {file_path}')
+
+    return info['width'], info['height']
 
 
 def find_closest_ratio(width: int, height: int) -> str:
@@ -51,26 +47,146 @@ def find_closest_ratio(width: int, height: int) -> str:
 
     return f"{best[0]}:{best[1]}"
 
+RUNWAY_MODEL = "gen4_aleph"
+# с фиксированным seed результат для одного клипа, промпта и ratio воспроизводим, поэтому его можно кешировать
+RUNWAY_SEED = 42
+RUNWAY_CACHE_DIR = os.path.join(CACHE_DIR, 'runway')
+
+_inflight = SingleFlight()
+
+# Опрос задач Runway: один цикл на все задачи, пауза растёт, пока ничего не меняется
+POLL_MIN_SEC = 2
+POLL_MAX_SEC = 30
+# сколько ждать одну задачу Runway, прежде чем считать её зависшей
+TASK_TIMEOUT_SEC = 15 * 60
+DOWNLOAD_CHUNK = 1024 * 1024
+
+
+class RunwayTaskPoller:
+    """
+    Общий опрос всех задач Runway вместо отдельного цикла на каждую.
+
+    wait() регистрирует задачу и ждёт её результата; фоновый цикл опрашивает все
+    незавершённые задачи за один проход и завершается, когда ждать больше нечего.
+    """
+
+    def __init__(self, client: AsyncRunwayML):
+        self.client = client
+        self._waiters = {}
+        self._loop_task = None
+        self._delay = POLL_MIN_SEC
+
+    async def wait(self, task_id: str):
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[task_id] = future
+        # новая задача - снова опрашиваем часто
+        self._delay = POLL_MIN_SEC
+
+        if self._loop_task is None or self._loop_task.done():
+            self._loop_task = asyncio.create_task(self._run())
+
+        try:
+            return await asyncio.wait_for(future, TASK_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            try:
+                # зависшая задача не должна дальше тратить кредиты
+                await self.client.tasks.delete(task_id)
+            except Exception as e:
+                print(f'ошибка отмены задачи runway {task_id}: {e}')
+            raise RuntimeError(f'runway не обработал видео за {TASK_TIMEOUT_SEC // 60} минут')
+        finally:
+            self._waiters.pop(task_id, None)
+
+    async def _run(self):
+        try:
+            await self._poll()
+        except Exception as e:
+            # цикл упал не на сетевой ошибке опроса: все ждущие задачи получают ошибку, а не висят
+            for future in self._waiters.values():
+                if not future.done():
+                    future.set_exception(RuntimeError(f'ошибка опроса задач runway: {e}'))
+
+    async def _poll(self):
+        while self._waiters:
+            await asyncio.sleep(self._delay)
+
+            task_ids = [task_id for task_id, future in self._waiters.items() if not future.done()]
+            statuses = await asyncio.gather(
+                *[self.client.tasks.retrieve(task_id) for task_id in task_ids],
+                return_exceptions=True
+            )
+
+            changed = False
+            for task_id, status in zip(task_ids, statuses):
+                future = self._waiters.get(task_id)
+                if future is None or future.done():
+                    continue
+
+                if isinstance(status, Exception):
+                    # сетевые ошибки опроса не валят задачу, попробуем на следующем проходе
+                    print(f'ошибка опроса задачи runway {task_id}: {status}')
+                    continue
+
+                if status.status == 'SUCCEEDED':
+                    future.set_result(status.output)
+                    changed = True
+                elif status.status in ("FAILED", "CANCELLED"):
+                    future.set_exception(RuntimeError(f'runway не смог обработать видео: {status}'))
+                    changed = True
+
+            self._delay = POLL_MIN_SEC if changed else min(self._delay * 1.5, POLL_MAX_SEC)
+
+    def close(self):
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+
+
+async def download_to_file(session: aiohttp.ClientSession, url: str, output_path: str):
+    # видео пишется на диск кусками по мере скачивания, целиком в памяти не держим
+    tmp_path = output_path + '.part'
+    try:
+        async with session.get(url) as resp:
+            if resp.status != 200:
+                raise RuntimeError('ошибка при скачивании файла')
+
+            with open(tmp_path, "wb") as f:
+                async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK):
+                    await asyncio.to_thread(f.write, chunk)
+
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 async def process_videos(
         videos_with_promts: dict[str, str],
         api_key: str,
 ) -> list[str]:
     
     client = AsyncRunwayML(api_key=api_key)
+    poller = RunwayTaskPoller(client)
 
     tasks = []
 
-    for file_path, promt in videos_with_promts.items():
-        
-        task = process_single_video_with_own_prompt(
-            client=client,
-            file_path=file_path,
-            promt=promt
-        )
+    # одна сессия с пулом соединений на все скачивания пачки
+    async with aiohttp.ClientSession() as session:
+        for file_path, promt in videos_with_promts.items():
+            
+            task = process_single_video_with_own_prompt(
+                client=client,
+                poller=poller,
+                session=session,
+                file_path=file_path,
+                promt=promt
+            )
 
-        tasks.append(task)
+            tasks.append(task)
 
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            poller.close()
 
     output_files = []
 
@@ -85,8 +201,17 @@ async def process_videos(
 
 
 
+def runway_cache_key(upload_path: str, promt: str, ratio: str) -> str:
+    # хеш всего загружаемого файла: по совпавшему ключу пользователь получит уже оплаченный результат
+    content_hash = file_sha256(upload_path)
+    raw = f"{content_hash}|{RUNWAY_MODEL}|{RUNWAY_SEED}|{ratio}|{promt}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
 async def process_single_video_with_own_prompt(
         client: AsyncRunwayML,
+        poller: RunwayTaskPoller,
+        session: aiohttp.ClientSession,
         file_path: str,
         promt: str
 ) -> str:
@@ -98,51 +223,71 @@ async def process_single_video_with_own_prompt(
     width, height = await get_video_resolution_async(file_path)
     ratio = find_closest_ratio(width, height)
 
+    # Runway всё равно отдаёт результат в ratio, лишние пиксели не загружаем
+    upload_path = await runway_proxy(file_path, ratio)
+
+    key = await asyncio.to_thread(runway_cache_key, upload_path, promt, ratio)
+    cache_path = os.path.join(RUNWAY_CACHE_DIR, f"{key}.mp4")
+
+    if os.path.exists(cache_path):
+        # такой клип с таким промптом уже генерировали, повторно не платим
+        inc('runway_cache_total', result='hit')
+        os.utime(cache_path)
+        await asyncio.to_thread(link_or_copy, cache_path, output_path)
+        return output_path
+
+    inc('runway_cache_total', result='shared' if key in _inflight else 'miss')
+
+    async def generate():
+        os.makedirs(RUNWAY_CACHE_DIR, exist_ok=True)
+        await _generate_with_runway(client, poller, session, upload_path, promt, ratio, cache_path)
+        await asyncio.to_thread(evict_files, RUNWAY_CACHE_DIR, RUNWAY_CACHE_MAX_BYTES, cache_path)
+
+    # одинаковые клипы с одинаковым промптом в одной пачке генерируются один раз
+    await _inflight.do(key, generate)
+    await asyncio.to_thread(link_or_copy, cache_path, output_path)
+    return output_path
+
+
+async def _generate_with_runway(
+        client: AsyncRunwayML,
+        poller: RunwayTaskPoller,
+        session: aiohttp.ClientSession,
+        upload_path: str,
+        promt: str,
+        ratio: str,
+        output_path: str
+):
+    video_uri = None
+
     for attempt in range(1, 4):
         try:
-            with open(file_path, "rb") as f:
-                upload = await client.uploads.create_ephemeral(
-                    file=f,
-                )
-            
-            video_uri = upload.uri
+            # файл загружается один раз, повторные попытки используют тот же uri
+            if video_uri is None:
+                with open(upload_path, "rb") as f:
+                    upload = await client.uploads.create_ephemeral(
+                        file=f,
+                    )
+                video_uri = upload.uri
 
             task = await client.video_to_video.create(
-                model="gen4_aleph",
+                model=RUNWAY_MODEL,
                 video_uri=video_uri,
                 prompt_text=promt,
                 ratio=ratio,
-                seed=42
+                seed=RUNWAY_SEED
             )
 
-            task_id = task.id
-
-            while True:
-                status = await client.tasks.retrieve(task_id)
-                
-                if status.status == 'SUCCEEDED':
-                    output_url = status.output
-                    break
-
-                if status.status in ("FAILED", "CANCELLED"):
-                    raise RuntimeError(f'runway не смог обработать видео: {status}')
-                
-                await asyncio.sleep(5)
-
-
-            async with aiohttp.ClientSession() as session:
-                async with session.get(output_url) as resp:
+            output = await poller.wait(task.id)
+            # runway отдаёт список ссылок на результат
+            output_url = output[0] if isinstance(output, list) else output
 
-                    if resp.status != 200:
-                        raise RuntimeError('ошибка при скачивании файла')
-                    
-                    with open(output_path, "wb") as f:
-                        f.write(await resp.read())
+            await download_to_file(session, output_url, output_path)
 
-            return output_path
+            return
 
         except Exception as e:
             print(f'попытка {attempt} для {output_path} неудачна', e)
 
             if attempt == 3:
-                raise RuntimeError('все попытки потрачены')
\ No newline at end of file
+                raise RuntimeError('все попытки потрачены')
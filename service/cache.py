@@ -0,0 +1,201 @@
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import closing
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def clear(self):
+        self._data.clear()
+
+
+class DiskCache:
+    """
+    Кеш ключ-значение в SQLite со сроком жизни записей и ограничением общего размера.
+
+    Значения хранятся как JSON. При превышении max_bytes удаляются записи,
+    к которым дольше всего не обращались.
+    """
+
+    def __init__(self, path: str, ttl: float = None, max_bytes: int = None):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._initialized = False
+
+    def _connect(self):
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        if not self._initialized:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)')
+            self._initialized = True
+        return conn
+
+    def get_sync(self, key: str, default=None):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT value, created_at FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return default
+
+            value, created_at = row
+            if self.ttl is not None and now - created_at > self.ttl:
+                conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+                return default
+
+            conn.execute('UPDATE cache SET accessed_at = ? WHERE key = ?', (now, key))
+            return json.loads(value)
+
+    def set_sync(self, key: str, value):
+        now = time.time()
+        data = json.dumps(value, ensure_ascii=False)
+        with closing(self._connect()) as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO cache (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                (key, data, len(data.encode()), now, now)
+            )
+            self._evict(conn, now)
+
+    def delete_sync(self, key: str):
+        with closing(self._connect()) as conn:
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def _evict(self, conn, now: float):
+        if self.ttl is not None:
+            conn.execute('DELETE FROM cache WHERE created_at < ?', (now - self.ttl,))
+
+        if self.max_bytes is None:
+            return
+
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        for key, size in conn.execute('SELECT key, size FROM cache ORDER BY accessed_at').fetchall():
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    async def get(self, key: str, default=None):
+        return await asyncio.to_thread(self.get_sync, key, default)
+
+    async def set(self, key: str, value):
+        await asyncio.to_thread(self.set_sync, key, value)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self.delete_sync, key)
+
+
+def link_or_copy(source: str, destination: str):
+    # жёсткая ссылка без копирования данных; на другой файловой системе - обычная копия
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def evict_files(directory: str, max_bytes: int, keep: str = None) -> int:
+    """
+    Удаляет из папки файлы, к которым дольше всего не обращались, пока общий размер больше max_bytes.
+
+    Время обращения - mtime, его обновляет тот, кто берёт файл из кеша. Файлы с несколькими
+    точками в имени (недописанные .tmp.mp4) не трогаются.
+
+    Returns:
+        Сколько файлов удалено
+    """
+    entries = []
+    total = 0
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.name.count('.') == 1:
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        os.remove(path)
+        total -= size
+        removed += 1
+    return removed
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные вызовы с одинаковым ключом в один.
+
+    Пока первый вызов не завершился, остальные ждут его результат (или исключение).
+    """
+
+    def __init__(self):
+        self._inflight = {}
+
+    async def do(self, key, func):
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # если ждущих нет, не даём asyncio ругаться на непрочитанное исключение
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._inflight
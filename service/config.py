@@ -0,0 +1,96 @@
+import os
+from dotenv import load_dotenv, find_dotenv
+
+load_dotenv(find_dotenv())
+
+
+# single_pass - весь план одним проходом через filter_complex,
+# smart - нарезка с копированием кусков между ключевыми кадрами и склейкой без перекодирования
+RENDER_MODE = os.getenv('RENDER_MODE', 'single_pass')
+
+# Бюджет CPU на весь хост: сколько ffmpeg-энкодеров работает одновременно во всех процессах
+# (бот и render_worker.py с общим CACHE_DIR) и сколько потоков у каждого
+CPU_COUNT = os.cpu_count() or 1
+ENCODER_SLOTS = int(os.getenv('ENCODER_SLOTS', max(1, CPU_COUNT // 4)))
+ENCODER_THREADS = int(os.getenv('ENCODER_THREADS', max(1, CPU_COUNT // ENCODER_SLOTS)))
+
+# Свой сервер Telegram Bot API (telegram-bot-api --local), пусто - облачный api.telegram.org;
+# папки нужны, если сервер видит свои файлы по другому пути (например, в контейнере)
+BOT_API_URL = os.getenv('BOT_API_URL', '')
+BOT_API_SERVER_FILES_DIR = os.getenv('BOT_API_SERVER_FILES_DIR', '')
+BOT_API_LOCAL_FILES_DIR = os.getenv('BOT_API_LOCAL_FILES_DIR', '')
+
+# Превью: быстрый рендер того же плана в низком разрешении, полный рендер - по кнопке;
+# PREVIEW_FIRST=1 - превью для каждого запроса, иначе только для запросов с /preview
+PREVIEW_FIRST = os.getenv('PREVIEW_FIRST', '0') == '1'
+PREVIEW_HEIGHT = int(os.getenv('PREVIEW_HEIGHT', 480))
+PREVIEW_FPS = int(os.getenv('PREVIEW_FPS', 15))
+
+# Очередь задач рендера (SQLite на локальном диске: бот и воркеры на одном хосте)
+JOBS_DB = os.getenv('JOBS_DB', 'jobs.sqlite3')
+JOB_LEASE_SEC = float(os.getenv('JOB_LEASE_SEC', 300))
+WORKER_POLL_SEC = float(os.getenv('WORKER_POLL_SEC', 2))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3))
+# сколько воркеров запускать внутри процесса бота; 0 - только отдельные render_worker.py
+EMBEDDED_WORKERS = int(os.getenv('EMBEDDED_WORKERS', 1))
+
+# Рабочие папки задач: по возможности в памяти (tmpfs), большие задачи и переполнение - на диске.
+# Оценка размера задачи - WORKSPACE_SIZE_FACTOR размеров исходника; WORKSPACE_JOB_MAX_BYTES - жёсткий
+# лимит на промежуточные файлы одной задачи, WORKSPACE_RAM_MAX_BYTES - на все папки в памяти
+WORKSPACE_RAM_DIR = os.getenv('WORKSPACE_RAM_DIR', '/dev/shm/video_bot')
+WORKSPACE_RAM_JOB_MAX_BYTES = int(os.getenv('WORKSPACE_RAM_JOB_MAX_BYTES', 1024 * 1024 * 1024))
+WORKSPACE_RAM_MAX_BYTES = int(os.getenv('WORKSPACE_RAM_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+WORKSPACE_JOB_MAX_BYTES = int(os.getenv('WORKSPACE_JOB_MAX_BYTES', 10 * 1024 * 1024 * 1024))
+WORKSPACE_SIZE_FACTOR = float(os.getenv('WORKSPACE_SIZE_FACTOR', 3))
+
+# Метрики: порт локального эндпоинта /metrics (0 - выключен) и папка с трейсами задач
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9100))
+TRACES_DIR = os.getenv('TRACES_DIR', 'traces')
+
+# Папка для кешей (пробы, планы, отрендеренные части)
+CACHE_DIR = os.getenv('CACHE_DIR', 'cache')
+
+# Цветовые эффекты части сворачиваются в одну 3D LUT; LUT_SIZE - число узлов по каждому каналу
+COLOR_LUT = os.getenv('COLOR_LUT', '1') == '1'
+LUT_SIZE = int(os.getenv('LUT_SIZE', 33))
+
+# Папка со скачанными исходниками и квота на неё: старые исходники вытесняются, когда она превышена
+SOURCES_DIR = os.getenv('SOURCES_DIR', 'downloads_video')
+SOURCE_CACHE_MAX_BYTES = int(os.getenv('SOURCE_CACHE_MAX_BYTES', 5 * 1024 * 1024 * 1024))
+# сколько секунд только что присланное видео защищено от вытеснения, пока пользователь пишет описание
+SOURCE_PIN_SEC = float(os.getenv('SOURCE_PIN_SEC', 3600))
+
+# Анализ стиля в Gemini: сколько анализов одновременно и сколько хранить готовые отчёты
+GEMINI_CONCURRENCY = int(os.getenv('GEMINI_CONCURRENCY', 2))
+STYLE_CACHE_TTL_SEC = float(os.getenv('STYLE_CACHE_TTL_SEC', 30 * 24 * 3600))
+
+# Кеш уменьшенных копий исходников для загрузки в Gemini и Runway
+PROXY_CACHE_MAX_BYTES = int(os.getenv('PROXY_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+
+# Кеш результатов Runway (генерация с фиксированным seed воспроизводима)
+RUNWAY_CACHE_MAX_BYTES = int(os.getenv('RUNWAY_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+
+# Сколько хранить результаты поиска Pexels (переводы описаний хранятся без срока)
+PEXELS_CACHE_TTL_SEC = float(os.getenv('PEXELS_CACHE_TTL_SEC', 7 * 24 * 3600))
+
+# Библиотека скачанных роликов Pexels (по ID видео)
+PEXELS_LIBRARY_MAX_BYTES = int(os.getenv('PEXELS_LIBRARY_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+
+# Кеш отрендеренных частей (0 - выключен) и сколько помнить file_id отправленных результатов
+RENDER_CACHE_MAX_BYTES = int(os.getenv('RENDER_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+DELIVERED_CACHE_TTL_SEC = float(os.getenv('DELIVERED_CACHE_TTL_SEC', 30 * 24 * 3600))
+
+# Кеш планов монтажа от LLM
+PLAN_CACHE_MEMORY_SIZE = int(os.getenv('PLAN_CACHE_MEMORY_SIZE', 1024))
+PLAN_CACHE_TTL_SEC = float(os.getenv('PLAN_CACHE_TTL_SEC', 7 * 24 * 3600))
+PLAN_CACHE_MAX_BYTES = int(os.getenv('PLAN_CACHE_MAX_BYTES', 50 * 1024 * 1024))
+
+# Ollama: адрес, модель и сколько держать модель загруженной (-1 - не выгружать)
+OLLAMA_BASE = os.getenv('OLLAMA_BASE', 'http://localhost:11434')
+OLLAMA_MODEL = os.getenv('OLLAMA_MODEL', 'llama3')
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '-1')
+if OLLAMA_KEEP_ALIVE.lstrip('-').isdigit():
+    OLLAMA_KEEP_ALIVE = int(OLLAMA_KEEP_ALIVE)
+
+# Потоковая генерация плана: части рендерятся, пока LLM ещё дописывает остальные
+STREAM_PLANS = os.getenv('STREAM_PLANS', '1') == '1'
@@ -0,0 +1,222 @@
+"""
+Приведение частей монтажа к общим параметрам перед склейкой.
+
+Части могут прийти из разных мест: нарезка исходника, переходы из effects/, результаты
+Runway (_neuro), стоковые вставки Pexels (_vstavka). Склейка без перекодирования работает
+только если у всех частей одинаковые кодеки, размер кадра, SAR, fps, формат пикселей
+и параметры звука. Каждая часть проверяется по параметрам задачи и перекодируется не больше
+одного раза, только если что-то не совпадает; после этого склейка идёт копированием потоков.
+"""
+import asyncio
+import json
+import os
+from fractions import Fraction
+
+from service.ffmpeg import THREADS_ARGS, run_ffmpeg
+from service.metrics import inc, span
+from service.render import SEGMENT_AUDIO_ARGS, SEGMENT_VIDEO_ARGS
+
+
+def _display_size(media_info: dict):
+    width, height = media_info.get('width'), media_info.get('height')
+    if abs(media_info.get('rotation') or 0) % 180 == 90:
+        width, height = height, width
+    return width, height
+
+
+def _fraction(rate):
+    try:
+        return Fraction(rate).limit_denominator(1001) if rate else None
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+# имена профилей h264 из ffprobe -> значения -profile:v у libx264
+X264_PROFILES = {'constrained baseline': 'baseline', 'baseline': 'baseline', 'main': 'main', 'high': 'high'}
+
+
+def _profile(name) -> str | None:
+    return X264_PROFILES.get((name or '').lower())
+
+
+def conform_target(media_info: dict) -> dict:
+    # параметры задачи берутся у исходника: в них же кодируются части с эффектами
+    width, height = _display_size(media_info)
+    # профиль и уровень - как у исходника h264, чтобы с ним совпадали куски, скопированные умной нарезкой
+    source_h264 = media_info.get('video_codec') == 'h264'
+    level = media_info.get('video_level') if source_h264 else None
+    return {
+        "video_codec": 'h264',
+        "profile": (_profile(media_info.get('video_profile')) if source_h264 else None) or 'high',
+        "level": level if level and level > 0 else None,
+        "width": width,
+        "height": height,
+        "sar": '1:1',
+        "fps": _fraction(media_info.get('fps')),
+        "pix_fmt": 'yuv420p',
+        "has_audio": bool(media_info.get('has_audio')),
+        "audio_codec": 'aac',
+        "sample_rate": media_info.get('sample_rate') or 48000,
+        "channels": media_info.get('channels') or 2,
+    }
+
+
+def encoder_args(target: dict) -> list:
+    # профиль, уровень и формат пикселей для всех частей, которые кодирует libx264: у склеенного потока
+    # одни параметры SPS; без -pix_fmt 10-битный исходник (HEVC Main10) не кодируется в профиле high
+    args = ['-pix_fmt', target['pix_fmt'], '-profile:v', target['profile']]
+    if target['level']:
+        args += ['-level', f"{target['level'] / 10:.1f}"]
+    return args
+
+
+async def stream_params(path: str) -> dict | None:
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-show_entries',
+        'stream=codec_type,codec_name,profile,level,width,height,sample_aspect_ratio,pix_fmt,r_frame_rate,sample_rate,channels'
+        ':stream_tags=rotate:stream_side_data=rotation',
+        '-of', 'json',
+        path
+    ]
+
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+
+    stdout, stderr = await process.communicate()
+
+    if process.returncode != 0:
+        return None
+
+    streams = json.loads(stdout.decode() or '{}').get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+    if video is None:
+        return None
+
+    rotation = video.get('tags', {}).get('rotate')
+    for side_data in video.get('side_data_list', []):
+        rotation = side_data.get('rotation', rotation)
+
+    sar = video.get('sample_aspect_ratio')
+    return {
+        "video_codec": video.get('codec_name'),
+        "profile": _profile(video.get('profile')),
+        "level": video.get('level'),
+        "width": video.get('width'),
+        "height": video.get('height'),
+        "rotation": int(float(rotation or 0)),
+        # у части без SAR пиксели квадратные
+        "sar": '1:1' if sar in (None, '0:1', 'N/A') else sar,
+        "fps": _fraction(video.get('r_frame_rate')),
+        "pix_fmt": video.get('pix_fmt'),
+        "has_audio": audio is not None,
+        "audio_codec": audio.get('codec_name') if audio else None,
+        "sample_rate": int(audio['sample_rate']) if audio and audio.get('sample_rate') else None,
+        "channels": audio.get('channels') if audio else None,
+    }
+
+
+def mismatches(params: dict, target: dict) -> list[str]:
+    """
+    Проверка совместимости части с параметрами задачи.
+
+    Returns:
+        Список параметров, которые не совпадают; пустой список - часть можно склеивать копированием
+    """
+    if params is None:
+        return ['streams']
+
+    # поворот из метаданных при склейке копированием берётся только у первой части
+    result = ['rotation'] if params['rotation'] % 360 else []
+    # склейка копированием берёт параметры кодека (avcC) только у первой части, поэтому профиль и уровень тоже
+    for key in ('video_codec', 'profile', 'width', 'height', 'sar', 'pix_fmt', 'has_audio'):
+        if params[key] != target[key]:
+            result.append(key)
+    if target['level'] and params['level'] != target['level']:
+        result.append('level')
+    if target['fps'] and params['fps'] != target['fps']:
+        result.append('fps')
+    if target['has_audio']:
+        for key in ('audio_codec', 'sample_rate', 'channels'):
+            if params[key] != target[key]:
+                result.append(key)
+    return result
+
+
+def conform_args(params: dict, target: dict) -> tuple[list, list]:
+    # (входы ffmpeg после основного файла, аргументы кодирования)
+    width, height = target['width'], target['height']
+    video_filters = [
+        f'scale={width}:{height}:force_original_aspect_ratio=decrease',
+        f'pad={width}:{height}:(ow-iw)/2:(oh-ih)/2',
+        'setsar=1',
+    ]
+    if target['fps']:
+        video_filters.append(f'fps={target["fps"]}')
+    video_filters.append(f'format={target["pix_fmt"]}')
+
+    extra_inputs = []
+    args = ['-vf', ','.join(video_filters), *SEGMENT_VIDEO_ARGS, *encoder_args(target)]
+
+    if not target['has_audio']:
+        args += ['-an']
+    else:
+        if params and params['has_audio']:
+            args += ['-map', '0:v:0', '-map', '0:a:0']
+        else:
+            # у перехода или вставки нет звука: добавляем тишину, иначе склейка потеряет дорожку
+            layout = 'mono' if target['channels'] == 1 else 'stereo'
+            extra_inputs = ['-f', 'lavfi', '-i', f'anullsrc=r={target["sample_rate"]}:cl={layout}']
+            args += ['-map', '0:v:0', '-map', '1:a:0', '-shortest']
+        args += [*SEGMENT_AUDIO_ARGS, '-ar', str(target['sample_rate']), '-ac', str(target['channels'])]
+
+    return extra_inputs, args
+
+
+async def conform_part(path: str, target: dict) -> str | None:
+    params = await stream_params(path)
+    diff = mismatches(params, target)
+    if not diff:
+        inc('conform_total', result='match')
+        return path
+
+    inc('conform_total', result='encode')
+    print(f"часть {os.path.basename(path)} приводится к параметрам задачи: {', '.join(diff)}")
+
+    output_path = f"{os.path.splitext(path)[0]}_conform.mp4"
+    extra_inputs, args = conform_args(params, target)
+    cmd = ['ffmpeg', '-i', path, *extra_inputs, *args, *THREADS_ARGS, '-y', output_path]
+
+    with span('conform', mismatches=','.join(diff)):
+        returncode, stderr = await run_ffmpeg(cmd)
+
+    if returncode != 0 or not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        print(f"ошибка FFmpeg при приведении части {path}: {stderr.decode()[-1000:]}")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return None
+    return output_path
+
+
+async def conform_parts(parts_paths: list, target: dict) -> list | None:
+    """
+    Приводит все части к параметрам задачи.
+
+    Returns:
+        Список файлов, которые склеиваются копированием, или None, если привести не удалось
+        (созданные копии при этом удалены)
+    """
+    results = await asyncio.gather(*[conform_part(path, target) for path in parts_paths])
+
+    if any(result is None for result in results):
+        for path, result in zip(parts_paths, results):
+            if result is not None and result != path and os.path.exists(result):
+                os.remove(result)
+        return None
+
+    return list(results)
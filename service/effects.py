@@ -0,0 +1,276 @@
+"""
+Реестр эффектов для монтажа.
+
+Каждый эффект описывается данными: цепочка видеофильтров, цепочка аудиофильтров,
+параметр интенсивности со значением по умолчанию и признак того, что звук можно
+скопировать без перекодирования. Несколько эффектов одной части собираются в одну
+цепочку фильтров и кодируются за один проход.
+
+Цветовые эффекты дополнительно описаны как преобразование RGB-массива, подряд идущие
+цветовые эффекты сворачиваются в одну 3D LUT (service/lut.py).
+"""
+import asyncio
+
+from service.config import COLOR_LUT
+from service.lut import color_lut, color_lut_filter, lut_available
+
+
+# веса яркости BT.601, как у eq/hue в ffmpeg для обычного видео
+LUMA = (0.299, 0.587, 0.114)
+
+
+def _atempo(speed: float) -> str:
+    # atempo принимает коэффициент от 0.5 до 2.0, большие изменения собираются цепочкой
+    filters = []
+    while speed < 0.5:
+        filters.append('atempo=0.5')
+        speed /= 0.5
+    while speed > 2.0:
+        filters.append('atempo=2.0')
+        speed /= 2.0
+    filters.append(f'atempo={speed:g}')
+    return ','.join(filters)
+
+
+def _sepia_matrix(p: float) -> list:
+    # смешиваем матрицу сепии с единичной, p=1 - полная сепия
+    matrix = [
+        [.393, .769, .189],
+        [.349, .686, .168],
+        [.272, .534, .131],
+    ]
+    return [
+        [round((1 - p) * (i == j) + p * value, 3) for j, value in enumerate(row)]
+        for i, row in enumerate(matrix)
+    ]
+
+
+def _sepia(p: float) -> str:
+    rows = [':'.join(f'{value:.3f}' for value in row) for row in _sepia_matrix(p)]
+    return 'colorchannelmixer=' + ':0:'.join(rows)
+
+
+# цветовые преобразования над массивом (..., 3) со значениями RGB от 0 до 1
+
+def _rgb_saturation(rgb, s: float):
+    luma = (rgb @ LUMA)[..., None]
+    return luma + s * (rgb - luma)
+
+
+def _rgb_contrast(rgb, c: float):
+    # eq меняет контраст только яркости, цветность остаётся прежней
+    luma = (rgb @ LUMA)[..., None]
+    return rgb + (luma - 0.5) * (c - 1)
+
+
+# video/audio - функция интенсивности -> строка фильтров (без audio звук не меняется)
+# default - интенсивность по умолчанию, geometry - эффект меняет размер кадра,
+# audio_copy - звук можно скопировать без перекодирования (по умолчанию да),
+# color - то же преобразование над RGB-массивом для сборки LUT (только для попиксельных цветовых эффектов)
+EFFECTS = {
+    "darken": {
+        "video": lambda p: f'eq=brightness={-p:g}:contrast=1.0',
+        "color": lambda rgb, p: rgb - p,
+        "default": 0.5,
+    },
+    "brighten": {
+        "video": lambda p: f'eq=brightness={p:g}:contrast=1.0',
+        "color": lambda rgb, p: rgb + p,
+        "default": 0.5,
+    },
+    "black_white": {
+        "video": lambda p: f'hue=s={1 - p:g}',
+        "color": lambda rgb, p: _rgb_saturation(rgb, 1 - p),
+        "default": 1.0,
+    },
+    "saturate": {
+        "video": lambda p: f'eq=saturation={1 + p:g}',
+        "color": lambda rgb, p: _rgb_saturation(rgb, 1 + p),
+        "default": 0.5,
+    },
+    "desaturate": {
+        "video": lambda p: f'eq=saturation={1 - p:g}',
+        "color": lambda rgb, p: _rgb_saturation(rgb, 1 - p),
+        "default": 0.5,
+    },
+    "blur": {
+        "video": lambda p: f'boxblur={max(1, round(10 * p))}:1',
+        "default": 0.5,
+    },
+    "sharpen": {
+        "video": lambda p: f'unsharp=5:5:{2 * p:g}:5:5:0.0',
+        "default": 0.5,
+    },
+    "contrast": {
+        "video": lambda p: f'eq=contrast={1 + p:g}',
+        "color": lambda rgb, p: _rgb_contrast(rgb, 1 + p),
+        "default": 0.5,
+    },
+    "zoom_in": {
+        "video": lambda p: f'crop=iw*{1 - p:g}:ih*{1 - p:g}:iw*{p / 2:g}:ih*{p / 2:g},scale=iw/{1 - p:g}:ih/{1 - p:g}',
+        "default": 0.2,
+        "geometry": True,
+    },
+    "zoom_out": {
+        "video": lambda p: f'scale=iw*{1 - p:g}:ih*{1 - p:g},pad=iw/{1 - p:g}:ih/{1 - p:g}:(ow-iw)/2:(oh-ih)/2:black',
+        "default": 0.2,
+        "geometry": True,
+    },
+    "slow_motion": {
+        "video": lambda p: f'setpts={1 / p:g}*PTS',
+        "audio": _atempo,
+        "audio_copy": False,
+        "default": 0.5,
+    },
+    "fast_motion": {
+        "video": lambda p: f'setpts={1 / p:g}*PTS',
+        "audio": _atempo,
+        "audio_copy": False,
+        "default": 2.0,
+    },
+    "rotate": {
+        "video": lambda p: 'transpose=1',
+        "default": None,
+        "geometry": True,
+    },
+    "flip_horizontal": {
+        "video": lambda p: 'hflip',
+        "default": None,
+    },
+    "flip_vertical": {
+        "video": lambda p: 'vflip',
+        "default": None,
+    },
+    "vignette": {
+        "video": lambda p: f'vignette={p:g}',
+        "default": 0.785,
+    },
+    "sepia": {
+        "video": _sepia,
+        "color": lambda rgb, p: rgb @ [list(column) for column in zip(*_sepia_matrix(p))],
+        "default": 1.0,
+    },
+    "invert": {
+        "video": lambda p: 'negate',
+        "color": lambda rgb, p: 1 - rgb,
+        "default": None,
+    },
+}
+
+# допустимые значения интенсивности, чтобы модель не сломала фильтр
+INTENSITY_LIMITS = {
+    "slow_motion": (0.1, 0.99),
+    "fast_motion": (1.01, 10.0),
+    "zoom_in": (0.05, 0.9),
+    "zoom_out": (0.05, 0.9),
+}
+
+
+def is_filter_effect(name: str) -> bool:
+    return name in EFFECTS
+
+
+def part_effects(part: dict) -> list[dict]:
+    """
+    Список эффектов части в виде [{"name": ..., "intensity": ...}].
+
+    Понимает новый формат (effects - список имён или объектов) и старый (effect_name).
+    """
+    if part.get('action') != 'edit':
+        return []
+
+    raw = part.get('effects')
+    if raw is None:
+        raw = [{"name": part.get('effect_name'), "intensity": part.get('intensity')}]
+
+    effects = []
+    for item in raw:
+        if isinstance(item, str):
+            item = {"name": item}
+        if item and item.get('name'):
+            effects.append({"name": item['name'], "intensity": item.get('intensity')})
+    return effects
+
+
+def _intensity(name: str, value):
+    effect = EFFECTS[name]
+    if effect['default'] is None:
+        return None
+    try:
+        value = float(value) if value is not None else effect['default']
+    except (TypeError, ValueError):
+        value = effect['default']
+    low, high = INTENSITY_LIMITS.get(name, (0.0, 1.0))
+    return min(max(value, low), high)
+
+
+def build_effect_chain(effects: list[dict]) -> dict:
+    """
+    Собирает эффекты части в одну цепочку фильтров.
+
+    Подряд идущие цветовые эффекты (два и больше) заменяются одним фильтром lut3d.
+
+    Returns:
+        {"video": [...], "audio": [...], "geometry": bool, "audio_copy": bool}
+    """
+    chain = {"video": [], "audio": [], "geometry": False, "audio_copy": True}
+    color_run = []
+
+    def flush_colors():
+        lut_filter = color_lut_filter(color_run) if COLOR_LUT and len(color_run) > 1 else None
+        if lut_filter:
+            chain['video'].append(lut_filter)
+        else:
+            # одиночный эффект точнее и не дороже своим фильтром
+            chain['video'].extend(EFFECTS[name]['video'](intensity) for name, intensity, _ in color_run)
+        color_run.clear()
+
+    for item in effects:
+        effect = EFFECTS[item['name']]
+        intensity = _intensity(item['name'], item.get('intensity'))
+
+        if effect.get('color'):
+            color_run.append((item['name'], intensity, effect['color']))
+        else:
+            flush_colors()
+            chain['video'].append(effect['video'](intensity))
+
+        if effect.get('audio'):
+            chain['audio'].append(effect['audio'](intensity))
+        chain['geometry'] = chain['geometry'] or effect.get('geometry', False)
+        chain['audio_copy'] = chain['audio_copy'] and effect.get('audio_copy', True)
+
+    flush_colors()
+    return chain
+
+
+def _color_runs(effects: list[dict]) -> list[list]:
+    # те же группы подряд идущих цветовых эффектов, что собирает build_effect_chain
+    runs = [[]]
+    for item in effects:
+        effect = EFFECTS[item['name']]
+        if effect.get('color'):
+            runs[-1].append((item['name'], _intensity(item['name'], item.get('intensity')), effect['color']))
+        elif runs[-1]:
+            runs.append([])
+    return [run for run in runs if len(run) > 1]
+
+
+async def prepare_color_luts(effect_lists: list[list[dict]]):
+    """
+    Заранее считает и записывает на диск LUT для цветовых эффектов, не занимая event loop.
+
+    После этого build_effect_chain берёт готовые файлы.
+    """
+    if not COLOR_LUT or not lut_available():
+        return
+    runs = {}
+    for effects in effect_lists:
+        for run in _color_runs([item for item in effects if is_filter_effect(item['name'])]):
+            runs[tuple((name, intensity) for name, intensity, _ in run)] = run
+    for run in runs.values():
+        await asyncio.to_thread(color_lut, run)
+
+
+def effects_label(effects: list[dict]) -> str:
+    return '+'.join(item['name'] for item in effects)
@@ -1,16 +1,214 @@
 import asyncio
+import bisect
 import os
 import shutil
+from contextlib import asynccontextmanager
 
+try:
+    import fcntl
+except ImportError:
+    # Windows: слоты считаются только внутри процесса
+    fcntl = None
+
+from service.config import CACHE_DIR, ENCODER_SLOTS, ENCODER_THREADS
+from service.effects import build_effect_chain, effects_label, is_filter_effect, prepare_color_luts
+from service.metrics import span
+
+
+ENCODER_SEMAPHORE = asyncio.Semaphore(ENCODER_SLOTS)
+THREADS_ARGS = ['-threads', str(ENCODER_THREADS)]
+
+# Слоты энкодеров на весь хост: бот и все render_worker.py с одним CACHE_DIR делят ENCODER_SLOTS.
+# Слот - файл с блокировкой flock, блокировка снимается сама, если процесс упал
+ENCODER_SLOTS_DIR = os.path.join(CACHE_DIR, 'encoder_slots')
+SLOT_POLL_MIN_SEC = 0.05
+SLOT_POLL_MAX_SEC = 0.5
+
+# Минимальная длина куска между ключевыми кадрами, который имеет смысл копировать без перекодирования
+SMART_CUT_MIN_COPY = 1.0
+
+
+def _try_host_slot():
+    os.makedirs(ENCODER_SLOTS_DIR, exist_ok=True)
+    for i in range(ENCODER_SLOTS):
+        fd = os.open(os.path.join(ENCODER_SLOTS_DIR, f'slot_{i}.lock'), os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except OSError:
+            os.close(fd)
+    return None
+
+
+@asynccontextmanager
+async def encoder_slot():
+    # семафор не даёт корутинам процесса зря опрашивать файлы, слот-файл - общий лимит хоста
+    async with ENCODER_SEMAPHORE:
+        if fcntl is None:
+            yield
+            return
+
+        delay = SLOT_POLL_MIN_SEC
+        fd = _try_host_slot()
+        while fd is None:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, SLOT_POLL_MAX_SEC)
+            fd = _try_host_slot()
+
+        try:
+            yield
+        finally:
+            # закрытие дескриптора снимает блокировку
+            os.close(fd)
+
+
+async def run_ffmpeg(cmd: list):
+    # общий на весь хост лимит одновременно работающих энкодеров
+    async with encoder_slot():
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+
+        try:
+            stdout, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            # задачу отменили: ffmpeg не должен продолжать работу и писать файлы
+            process.kill()
+            await process.wait()
+            raise
+
+    return process.returncode, stderr
+
+
+def plan_smart_cut(start_sec: float, end_sec: float, keyframes: list) -> list[tuple[float, float, str]]:
+    first = bisect.bisect_left(keyframes, start_sec)
+    last = bisect.bisect_right(keyframes, end_sec) - 1
+
+    if first >= len(keyframes) or last < first:
+        return [(start_sec, end_sec, 'encode')]
+
+    copy_start = keyframes[first]
+    copy_end = keyframes[last]
+
+    if copy_end - copy_start < SMART_CUT_MIN_COPY:
+        return [(start_sec, end_sec, 'encode')]
+
+    pieces = []
+    if copy_start - start_sec > 0.001:
+        pieces.append((start_sec, copy_start, 'encode'))
+    pieces.append((copy_start, copy_end, 'copy'))
+    if end_sec - copy_end > 0.001:
+        pieces.append((copy_end, end_sec, 'encode'))
+
+    return pieces
+
+
+async def smart_cut_part(
+        video_path: str,
+        start_sec: float,
+        end_sec: float,
+        keyframes: list,
+        output_part: str,
+        encode_args: list = None,
+        copy_audio: bool = True,
+):
+    pieces = plan_smart_cut(start_sec, end_sec, keyframes)
+    base = os.path.splitext(output_part)[0]
+    piece_files = []
+    list_file = f"{base}_pieces.txt"
 
-async def cut_video_into_parts(video_path: str, parts_info: list):
+    try:
+        for n, (piece_start, piece_end, mode) in enumerate(pieces):
+            piece_file = f"{base}_piece_{n}.ts"
+            piece_files.append(piece_file)
+
+            cmd = ['ffmpeg', '-ss', str(piece_start), '-i', video_path, '-t', str(piece_end - piece_start)]
+            if mode == 'copy':
+                # середина между ключевыми кадрами копируется как есть; звук не в AAC перекодируется,
+                # иначе куски не склеятся с границами, а aac_adtstoasc сломает поток
+                cmd += ['-c:v', 'copy', '-bsf:v', 'h264_mp4toannexb', '-c:a', 'copy' if copy_audio else 'aac']
+            else:
+                # неполные GOP на границах перекодируются в тот же кодек, профиль и уровень, что у исходника
+                cmd += ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', *(encode_args or []), '-c:a', 'aac', *THREADS_ARGS]
+            cmd += ['-f', 'mpegts', '-y', piece_file]
+
+            returncode, stderr = await run_ffmpeg(cmd)
+            if returncode != 0:
+                print(f"ошибка FFmpeg при умной нарезке: {stderr.decode()[-1000:]}")
+                return False
+
+        with open(list_file, 'w', encoding='utf-8') as f:
+            for piece_file in piece_files:
+                abs_path = os.path.abspath(piece_file).replace("'", "'\\''")
+                f.write(f"file '{abs_path}'\n")
+
+        cmd = [
+            'ffmpeg',
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', list_file,
+            '-c', 'copy',
+            '-bsf:a', 'aac_adtstoasc',
+            '-y',
+            output_part
+        ]
+        returncode, stderr = await run_ffmpeg(cmd)
+        return returncode == 0
+
+    finally:
+        for f in piece_files + [list_file]:
+            if os.path.exists(f):
+                os.remove(f)
+
+
+async def _cut_single_part(
+        video_path: str,
+        part: dict,
+        output_part: str,
+        smart: bool,
+        keyframes: list,
+        encode_args: list,
+        copy_audio: bool,
+) -> bool:
+    start_sec = float(part.get('start_sec', 0))
+    end_sec = float(part.get('end_sec', 0))
+
+    if smart and part.get('action') != 'edit':
+        with span('cut', start=start_sec, end=end_sec, mode='smart'):
+            return await smart_cut_part(video_path, start_sec, end_sec, keyframes, output_part, encode_args, copy_audio)
+
+    # -ss перед -i: ffmpeg перематывает к нужному месту, а не декодирует файл с начала
+    cmd = [
+        'ffmpeg',
+        '-ss', str(start_sec),
+        '-i', video_path,
+        '-t', str(end_sec - start_sec),
+        '-c:v', 'libx264',
+        *encode_args,
+        '-c:a', 'aac',
+        *THREADS_ARGS,
+        '-y',
+        output_part
+    ]
+    with span('cut', start=start_sec, end=end_sec, mode='encode'):
+        returncode, stderr = await run_ffmpeg(cmd)
+    return returncode == 0
+
+
+async def cut_video_into_parts(
+        video_path: str,
+        parts_info: list,
+        keyframes=None,
+        encode_args: list = None,
+        copy_audio: bool = True,
+):
     try:
         video_dir = os.path.dirname(video_path)
         video_name = os.path.basename(video_path)
         name_without_ext = os.path.splitext(video_name)[0]
 
-        output_files = []
-
         for i, part in enumerate(parts_info, 1):
             start_sec = float(part.get('start_sec', 0))
             end_sec = float(part.get('end_sec', 0))
@@ -20,170 +218,80 @@ async def cut_video_into_parts(video_path: str, parts_info: list):
                 return [f"ошибка, некорректная длительность части {i} (начало: {start_sec}, конец: {end_sec})"]
             if start_sec < 0:
                 return [f"ошибка, отрицательное время начала части {i}"]
-            
-            output_part = os.path.join(video_dir, f"{name_without_ext}_part_{i}.mp4")
 
-            cmd = [
-                'ffmpeg',
-                '-i', video_path,
-                '-ss', str(start_sec),
-                '-t', str(duration),
-                '-c:v', 'libx264',
-                '-c:a', 'aac',
-                '-y',
-                output_part
-            ]
+        # с индексом ключевых кадров нетронутые части режутся умной нарезкой
+        smart = keyframes is not None
 
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
+        output_parts = [
+            os.path.join(video_dir, f"{name_without_ext}_part_{i}.mp4")
+            for i in range(1, len(parts_info) + 1)
+        ]
 
-            stdout, stderr = await process.communicate()
+        # части режутся параллельно, число одновременных ffmpeg ограничено ENCODER_SLOTS
+        results = await asyncio.gather(*[
+            _cut_single_part(video_path, part, output_part, smart, keyframes, encode_args or [], copy_audio)
+            for part, output_part in zip(parts_info, output_parts)
+        ])
 
-            if process.returncode != 0:
-                for f in output_files:
-                    if os.path.exists(f):
-                        os.remove(f)
+        for i, (cut_ok, output_part) in enumerate(zip(results, output_parts), 1):
+            if cut_ok and os.path.exists(output_part) and os.path.getsize(output_part) > 0:
+                continue
+
+            # остальные части могли успеть нарезаться параллельно, удаляем их все
+            for f in output_parts:
+                if os.path.exists(f):
+                    os.remove(f)
+
+            if not cut_ok:
                 return [f'ошибка при создании части {i}']
-            
-            if os.path.exists(output_part) and os.path.getsize(output_part) > 0:
-                output_files.append(output_part)
-            else:
-                return [f"ошибка: файл части {i} не был создан"]
-            
-        return output_files
+            return [f"ошибка: файл части {i} не был создан"]
+
+        return output_parts
     
     except Exception as e:
         return [f'ошибка при разрезании видео: {str(e)}']
     
 
-async def replace_with_effect(original_part_path: str, effect_name: str):
+async def replace_with_effect(original_part_path: str, effects, encode_args: list = None):
+    if isinstance(effects, str):
+        effects = [{"name": effects}]
+    with span('effect', effect=effects_label(effects)):
+        return await _replace_with_effect(original_part_path, effects, encode_args or [])
+
+
+async def _replace_with_effect(original_part_path: str, effects: list, encode_args: list):
     try:
         video_dir = os.path.dirname(original_part_path)
         part_name = os.path.basename(original_part_path)
         name_without_ext = os.path.splitext(part_name)[0]
         
-        effect_output = os.path.join(video_dir, f"{name_without_ext}_{effect_name}.mp4")
-        
-        vf_filter = None
-        
-        if effect_name == "darken":
-            vf_filter = 'eq=brightness=-0.5:contrast=1.0'
-        
-        elif effect_name == "brighten":
-            vf_filter = 'eq=brightness=0.5:contrast=1.0'
-        
-        elif effect_name == "black_white":
-            vf_filter = 'hue=s=0'
-        
-        elif effect_name == "saturate":
-            vf_filter = 'eq=saturation=1.5'
-        
-        elif effect_name == "desaturate":
-            vf_filter = 'eq=saturation=0.5'
-        
-        elif effect_name == "blur":
-            vf_filter = 'boxblur=5:1'
-        
-        elif effect_name == "sharpen":
-            vf_filter = 'unsharp=5:5:1.0:5:5:0.0'
-        
-        elif effect_name == "contrast":
-            vf_filter = 'eq=contrast=1.5'
-        
-        elif effect_name == "zoom_in":
-            vf_filter = 'crop=iw*0.8:ih*0.8:iw*0.1:ih*0.1,scale=iw*1.25:ih*1.25'
-        
-        elif effect_name == "zoom_out":
-            vf_filter = 'scale=iw*0.8:ih*0.8,pad=iw:ih:(ow-iw)/2:(oh-ih)/2:black'
-        
-        elif effect_name == "slow_motion":
-            vf_filter = 'setpts=2.0*PTS'
-            cmd = [
-                'ffmpeg',
-                '-i', original_part_path,
-                '-filter_complex', '[0:v]setpts=2.0*PTS[v];[0:a]atempo=0.5[a]',
-                '-map', '[v]',
-                '-map', '[a]',
-                '-c:v', 'libx264',
-                '-c:a', 'aac',
-                '-y',
-                effect_output
-            ]
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await process.communicate()
-            if process.returncode == 0 and os.path.exists(effect_output) and os.path.getsize(effect_output) > 0:
-                return effect_output
-            return original_part_path
-        
-        elif effect_name == "fast_motion":
-            vf_filter = 'setpts=0.5*PTS'
-            cmd = [
-                'ffmpeg',
-                '-i', original_part_path,
-                '-filter_complex', '[0:v]setpts=0.5*PTS[v];[0:a]atempo=2.0[a]',
-                '-map', '[v]',
-                '-map', '[a]',
-                '-c:v', 'libx264',
-                '-c:a', 'aac',
-                '-y',
-                effect_output
-            ]
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, stderr = await process.communicate()
-            if process.returncode == 0 and os.path.exists(effect_output) and os.path.getsize(effect_output) > 0:
-                return effect_output
-            return original_part_path
-        
-        elif effect_name == "rotate":
-            vf_filter = 'transpose=1'
-        
-        elif effect_name == "flip_horizontal":
-            vf_filter = 'hflip'
+        effect_output = os.path.join(video_dir, f"{name_without_ext}_{effects_label(effects)}.mp4")
         
-        elif effect_name == "flip_vertical":
-            vf_filter = 'vflip'
+        filter_effects = [effect for effect in effects if is_filter_effect(effect['name'])]
         
-        elif effect_name == "vignette":
-            vf_filter = 'vignette=PI/4'
-        
-        elif effect_name == "sepia":
-            vf_filter = 'colorchannelmixer=.393:.769:.189:0:.349:.686:.168:0:.272:.534:.131'
-        
-        elif effect_name == "invert":
-            vf_filter = 'negate'
-        
-        if vf_filter:
+        if filter_effects:
+            # все эффекты части собираются в одну цепочку и кодируются за один запуск
+            await prepare_color_luts([filter_effects])
+            chain = build_effect_chain(filter_effects)
             cmd = [
                 'ffmpeg',
                 '-i', original_part_path,
-                '-vf', vf_filter,
+                '-vf', ','.join(chain['video']),
                 '-c:v', 'libx264',
-                '-c:a', 'copy',
-                '-y',
-                effect_output
+                *encode_args,
             ]
+            if chain['audio']:
+                cmd += ['-af', ','.join(chain['audio']), '-c:a', 'aac']
+            elif chain['audio_copy']:
+                cmd += ['-c:a', 'copy']
+            else:
+                cmd += ['-c:a', 'aac']
+            cmd += [*THREADS_ARGS, '-y', effect_output]
             
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            stdout, stderr = await process.communicate()
+            returncode, stderr = await run_ffmpeg(cmd)
             
-            if process.returncode != 0:
-                print(f"ошибка FFmpeg для эффекта {effect_name}: {stderr.decode()}")
+            if returncode != 0:
+                print(f"ошибка FFmpeg для эффектов {effects_label(filter_effects)}: {stderr.decode()}")
                 return original_part_path
             
             if os.path.exists(effect_output) and os.path.getsize(effect_output) > 0:
@@ -191,6 +299,7 @@ async def replace_with_effect(original_part_path: str, effect_name: str):
             else:
                 return original_part_path
         
+        effect_name = effects[0]['name']
         effect_path = f"effects/{effect_name}.mp4"
         
         if not os.path.exists(effect_path):
@@ -213,7 +322,7 @@ async def replace_with_effect(original_part_path: str, effect_name: str):
         return original_part_path
 
 
-async def merge_video_parts(parts_paths: list, original_name: str):
+async def merge_video_parts(parts_paths: list, original_name: str, copy: bool = False):
     try:
         if not parts_paths:
             return "ошибка: нету частей для склейки"
@@ -235,29 +344,30 @@ async def merge_video_parts(parts_paths: list, original_name: str):
         
         output_video = os.path.join(video_dir, f"{original_name}_final.mp4")
         
+        if copy:
+            # видео копируется, звук перекодируется: у каждой отдельно закодированной части AAC свои
+            # priming-сэмплы, и при копировании звук отставал бы от видео на каждом стыке
+            codec_args = ['-c:v', 'copy', '-c:a', 'aac', *THREADS_ARGS]
+        else:
+            codec_args = ['-c:v', 'libx264', '-c:a', 'aac', *THREADS_ARGS]
+
         cmd = [
             'ffmpeg', 
             '-f', 'concat',
             '-safe', '0',
             '-i', list_file,
-            '-c:v', 'libx264', 
-            '-c:a', 'aac', 
+            *codec_args,
             '-y', 
             output_video
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        stdout, stderr = await process.communicate()
+        with span('merge', copy=copy):
+            returncode, stderr = await run_ffmpeg(cmd)
         
         if os.path.exists(list_file):
             os.remove(list_file)
 
-        if process.returncode != 0:
+        if returncode != 0:
             if os.path.exists(output_video):
                 os.remove(output_video)
             return f"ошибка при склейке видео"
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import sqlite3
+import time
+from contextlib import closing
+
+from service.config import JOB_LEASE_SEC, JOBS_DB
+
+
+# Этапы задачи: после каждого этап сохраняется, и после падения воркер продолжает с последнего
+STAGE_QUEUED = 'queued'
+STAGE_PLANNED = 'planned'
+STAGE_RENDERED = 'rendered'
+STAGE_DONE = 'done'
+STAGE_FAILED = 'failed'
+
+FINISHED_STAGES = (STAGE_DONE, STAGE_FAILED)
+
+
+def _connect():
+    conn = sqlite3.connect(JOBS_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            video_path TEXT NOT NULL,
+            prompt TEXT NOT NULL,
+            file_key TEXT,
+            preview INTEGER NOT NULL DEFAULT 0,
+            download_started REAL,
+            download_sec REAL,
+            stage TEXT NOT NULL,
+            plan TEXT,
+            result TEXT,
+            error TEXT,
+            worker TEXT,
+            lease_until REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    _migrate(conn)
+    return conn
+
+
+def _migrate(conn):
+    # базы, созданные до появления колонок file_key, preview и download_*
+    columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+    if 'file_key' not in columns:
+        conn.execute('ALTER TABLE jobs ADD COLUMN file_key TEXT')
+    if 'preview' not in columns:
+        conn.execute('ALTER TABLE jobs ADD COLUMN preview INTEGER NOT NULL DEFAULT 0')
+    if 'download_sec' not in columns:
+        conn.execute('ALTER TABLE jobs ADD COLUMN download_started REAL')
+        conn.execute('ALTER TABLE jobs ADD COLUMN download_sec REAL')
+
+
+def _row_to_job(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job['plan'] = json.loads(job['plan']) if job['plan'] else None
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    job['preview'] = bool(job['preview'])
+    return job
+
+
+def _enqueue(
+        chat_id: int, video_path: str, prompt: str, file_key: str = None, preview: bool = False,
+        plan: dict = None, download: tuple = None,
+) -> int:
+    now = time.time()
+    # с готовым планом (полный рендер после превью) задача сразу начинается с рендера
+    stage = STAGE_PLANNED if plan is not None else STAGE_QUEUED
+    # (начало, длительность) скачивания исходника в хендлере, чтобы показать его в трейсе задачи
+    download_started, download_sec = download or (None, None)
+    with closing(_connect()) as conn:
+        cursor = conn.execute(
+            '''INSERT INTO jobs (chat_id, video_path, prompt, file_key, preview, download_started, download_sec,
+                                 stage, plan, created_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (
+                chat_id, video_path, prompt, file_key, int(preview), download_started, download_sec, stage,
+                json.dumps(plan, ensure_ascii=False) if plan is not None else None, now, now
+            )
+        )
+        return cursor.lastrowid
+
+
+def _get(job_id: int):
+    with closing(_connect()) as conn:
+        return _row_to_job(conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+
+def _claim(worker_id: str):
+    now = time.time()
+    conn = _connect()
+    try:
+        # BEGIN IMMEDIATE берёт блокировку на запись, так что одну задачу не заберут два воркера
+        conn.execute('BEGIN IMMEDIATE')
+        # у каждой задачи своя рабочая папка (service/workspace.py), задачи с одним исходником идут параллельно
+        row = conn.execute(
+            f'''SELECT * FROM jobs
+                WHERE stage NOT IN ({",".join("?" * len(FINISHED_STAGES))})
+                  AND (lease_until IS NULL OR lease_until < ?)
+                ORDER BY id LIMIT 1''',
+            (*FINISHED_STAGES, now)
+        ).fetchone()
+
+        if row is None:
+            conn.execute('COMMIT')
+            return None
+
+        conn.execute(
+            'UPDATE jobs SET worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?',
+            (worker_id, now + JOB_LEASE_SEC, now, row['id'])
+        )
+        conn.execute('COMMIT')
+
+        job = _row_to_job(row)
+        job['worker'] = worker_id
+        job['attempts'] += 1
+        return job
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+def _update(job_id: int, owner: str = None, **fields) -> bool:
+    for key in ('plan', 'result'):
+        if key in fields and fields[key] is not None:
+            fields[key] = json.dumps(fields[key], ensure_ascii=False)
+    fields['updated_at'] = time.time()
+
+    columns = ', '.join(f'{key} = ?' for key in fields)
+    query = f'UPDATE jobs SET {columns} WHERE id = ?'
+    params = [*fields.values(), job_id]
+    if owner is not None:
+        # воркер меняет задачу, только пока она за ним: после истечения аренды её мог забрать другой
+        query += ' AND worker = ?'
+        params.append(owner)
+
+    with closing(_connect()) as conn:
+        return conn.execute(query, params).rowcount > 0
+
+
+async def enqueue_job(
+        chat_id: int, video_path: str, prompt: str, file_key: str = None, preview: bool = False,
+        plan: dict = None, download: tuple = None,
+) -> int:
+    return await asyncio.to_thread(_enqueue, chat_id, video_path, prompt, file_key, preview, plan, download)
+
+
+async def get_job(job_id: int):
+    return await asyncio.to_thread(_get, job_id)
+
+
+async def claim_job(worker_id: str):
+    return await asyncio.to_thread(_claim, worker_id)
+
+
+async def update_job(job_id: int, owner: str = None, **fields) -> bool:
+    """
+    Обновляет поля задачи.
+
+    Returns:
+        False, если задан owner, а задача уже принадлежит другому воркеру
+    """
+    return await asyncio.to_thread(_update, job_id, owner, **fields)
+
+
+async def renew_lease(job_id: int, owner: str) -> bool:
+    return await update_job(job_id, owner, lease_until=time.time() + JOB_LEASE_SEC)
+
+
+async def release_job(job_id: int, stage: str, owner: str = None, **fields) -> bool:
+    return await update_job(job_id, owner, stage=stage, worker=None, lease_until=None, **fields)
+
+
+def _active_video_paths() -> set:
+    with closing(_connect()) as conn:
+        rows = conn.execute(
+            f'SELECT DISTINCT video_path FROM jobs WHERE stage NOT IN ({",".join("?" * len(FINISHED_STAGES))})',
+            FINISHED_STAGES
+        ).fetchall()
+    return {row['video_path'] for row in rows}
+
+
+async def active_video_paths() -> set:
+    return await asyncio.to_thread(_active_video_paths)
+
+
+def _active_job_ids() -> set:
+    with closing(_connect()) as conn:
+        rows = conn.execute(
+            f'SELECT id FROM jobs WHERE stage NOT IN ({",".join("?" * len(FINISHED_STAGES))})',
+            FINISHED_STAGES
+        ).fetchall()
+    return {row['id'] for row in rows}
+
+
+async def active_job_ids() -> set:
+    return await asyncio.to_thread(_active_job_ids)
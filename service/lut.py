@@ -0,0 +1,72 @@
+import hashlib
+import os
+
+from service.config import CACHE_DIR, LUT_SIZE
+
+try:
+    import numpy as np
+except ImportError:
+    # без numpy цветовые эффекты применяются своими фильтрами, без общей LUT
+    np = None
+
+
+LUT_CACHE_DIR = os.path.join(CACHE_DIR, 'lut')
+
+_ready = set()
+
+
+def _lut_key(steps: list) -> str:
+    raw = '|'.join(f'{name}:{intensity}' for name, intensity, _ in steps)
+    return hashlib.sha1(f'{LUT_SIZE}|{raw}'.encode()).hexdigest()[:16]
+
+
+def build_lut(steps: list, size: int = LUT_SIZE):
+    """
+    Считает таблицу 3D LUT для цепочки цветовых преобразований.
+
+    Args:
+        steps: [(имя, интенсивность, функция над RGB-массивом), ...] в порядке применения
+        size: Число узлов по каждому каналу
+
+    Returns:
+        Массив (size ** 3, 3) в порядке .cube: быстрее всего меняется красный канал
+    """
+    grid = np.linspace(0.0, 1.0, size)
+    b, g, r = np.meshgrid(grid, grid, grid, indexing='ij')
+    rgb = np.stack([r, g, b], axis=-1).reshape(-1, 3)
+
+    # вся решётка обрабатывается разом, ffmpeg тоже обрезает значения после каждого фильтра
+    for _, intensity, transform in steps:
+        rgb = np.clip(transform(rgb, intensity), 0.0, 1.0)
+
+    return rgb
+
+
+def _write_cube(path: str, table, size: int):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(f'LUT_3D_SIZE {size}\n')
+        np.savetxt(f, table, fmt='%.6f')
+    os.replace(path + '.tmp', path)
+
+
+def lut_available() -> bool:
+    return np is not None
+
+
+def color_lut(steps: list) -> str:
+    # таблица для одной и той же комбинации эффектов считается один раз и лежит на диске;
+    # из асинхронного кода вызывается через asyncio.to_thread (см. effects.prepare_color_luts)
+    path = os.path.join(LUT_CACHE_DIR, f'{_lut_key(steps)}.cube')
+    if path not in _ready:
+        if not os.path.exists(path):
+            _write_cube(path, build_lut(steps), LUT_SIZE)
+        _ready.add(path)
+    return path
+
+
+def color_lut_filter(steps: list) -> str | None:
+    if np is None:
+        return None
+    path = color_lut(steps).replace('\\', '/').replace(':', '\\:')
+    return f"lut3d=file='{path}'"
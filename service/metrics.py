@@ -0,0 +1,154 @@
+import contextvars
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+from service.config import METRICS_PORT, TRACES_DIR
+
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_counters = {}
+_histograms = {}
+
+# спаны текущей задачи; задачи из asyncio.gather наследуют контекст и пишут в тот же список
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    key = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels):
+    key = _key(name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+
+    for i, bound in enumerate(BUCKETS):
+        if value <= bound:
+            histogram['buckets'][i] += 1
+    histogram['sum'] += value
+    histogram['count'] += 1
+
+
+def annotate(**fields):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace['meta'].update(fields)
+
+
+@contextmanager
+def span(stage: str, **labels):
+    started = time.time()
+    status = 'ok'
+    try:
+        yield
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        duration = time.time() - started
+        observe('stage_duration_seconds', duration, stage=stage)
+        if status == 'error':
+            inc('stage_errors_total', stage=stage)
+
+        add_span(stage, started, duration, status, **labels)
+
+
+def add_span(stage: str, started: float, duration: float, status: str = 'ok', **labels):
+    # спан в трейс текущей задачи; этапы до начала задачи (скачивание в хендлере) получают start < 0
+    trace = _current_trace.get()
+    if trace is not None:
+        trace['spans'].append({
+            'stage': stage,
+            'start': round(started - trace['started'], 4),
+            'duration': round(duration, 4),
+            'status': status,
+            **labels,
+        })
+
+
+@contextmanager
+def job_trace(job_id):
+    trace = {'job_id': job_id, 'started': time.time(), 'spans': [], 'meta': {}}
+    token = _current_trace.set(trace)
+    try:
+        with span('job'):
+            yield trace
+    finally:
+        _current_trace.reset(token)
+        _write_trace(trace)
+
+
+def _write_trace(trace: dict):
+    try:
+        os.makedirs(TRACES_DIR, exist_ok=True)
+        path = os.path.join(TRACES_DIR, f"{trace['job_id']}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(trace, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        print(f"ошибка записи трейса задачи {trace['job_id']}: {e}")
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+def render_metrics() -> str:
+    lines = []
+
+    for name in sorted({name for name, _ in _counters}):
+        lines.append(f'# TYPE {name} counter')
+        for (metric, labels), value in _counters.items():
+            if metric == name:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+
+    for name in sorted({name for name, _ in _histograms}):
+        lines.append(f'# TYPE {name} histogram')
+        for (metric, labels), histogram in _histograms.items():
+            if metric != name:
+                continue
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {count}')
+            lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {histogram["count"]}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {histogram["sum"]}')
+            lines.append(f'{name}_count{_format_labels(labels)} {histogram["count"]}')
+
+    return '\n'.join(lines) + '\n'
+
+
+async def _metrics_handler(request):
+    return web.Response(text=render_metrics(), content_type='text/plain')
+
+
+async def start_metrics_server(port: int = METRICS_PORT):
+    if not port:
+        return None
+
+    app = web.Application()
+    app.router.add_get('/metrics', _metrics_handler)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # только localhost: эндпоинт для локального Prometheus, наружу не публикуем
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    try:
+        await site.start()
+    except OSError as e:
+        print(f"не удалось открыть порт метрик {port}: {e}")
+        await runner.cleanup()
+        return None
+    print(f"метрики доступны на http://127.0.0.1:{port}/metrics")
+    return runner
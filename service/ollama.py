@@ -1,26 +1,132 @@
 import asyncio
 import httpx
+import json
 import os
-from service.prompts import get_system_prompt
+import time
+from service.config import OLLAMA_BASE, OLLAMA_KEEP_ALIVE, OLLAMA_MODEL
+from service.metrics import add_span, annotate, inc, observe, span
+from service.plan_cache import get_or_create_plan
+from service.prompts import PLAN_SCHEMA, get_system_prompt
 
-OLLAMA_BASE = 'http://localhost:11434'
 
+# Один клиент на весь процесс: соединение с Ollama переиспользуется между запросами
+_client = None
 
-async def ask_ollama(prompt: str, model: str = 'llama3'):
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(base_url=OLLAMA_BASE, timeout=220.0)
+    return _client
+
+
+async def _preload_model(model: str):
+    # запрос без prompt только загружает модель в память, keep_alive не даёт её выгрузить
+    try:
+        with span('llm_preload', model=model):
+            r = await _get_client().post("/api/generate", json={"model": model, "keep_alive": OLLAMA_KEEP_ALIVE})
+            r.raise_for_status()
+        print(f"модель {model} загружена в Ollama")
+    except httpx.HTTPError as e:
+        print(f"не удалось прогреть модель {model} в Ollama: {e}")
+
+
+async def start_ollama(model: str = OLLAMA_MODEL):
+    _get_client()
+    # прогрев идёт в фоне, чтобы не задерживать запуск бота
+    return asyncio.create_task(_preload_model(model))
+
+
+async def close_ollama():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _record_ollama_timings(data: dict, model: str):
+    # Ollama отдаёт длительности в наносекундах
+    for field, metric in (
+        ('load_duration', 'ollama_load_seconds'),
+        ('prompt_eval_duration', 'ollama_prompt_eval_seconds'),
+        ('eval_duration', 'ollama_eval_seconds'),
+    ):
+        if data.get(field):
+            observe(metric, data[field] / 1e9, model=model)
+
+    inc('ollama_prompt_tokens_total', data.get('prompt_eval_count', 0), model=model)
+    inc('ollama_generated_tokens_total', data.get('eval_count', 0), model=model)
+
+    # в трейс задачи - те же этапы внутри спана llm: загрузка модели, разбор промпта, генерация;
+    # Ollama не отдаёт время начала, этапы откладываются подряд от конца ответа назад на total_duration
+    started = time.time() - data.get('total_duration', 0) / 1e9
+    for field, stage in (
+        ('load_duration', 'llm.load'),
+        ('prompt_eval_duration', 'llm.prompt_eval'),
+        ('eval_duration', 'llm.eval'),
+    ):
+        duration = data.get(field, 0) / 1e9
+        if duration:
+            add_span(stage, started, duration, model=model)
+            started += duration
+    annotate(
+        llm_prompt_tokens=data.get('prompt_eval_count', 0),
+        llm_generated_tokens=data.get('eval_count', 0),
+    )
+
+
+def _build_payload(prompt: str, model: str, response_format, stream: bool) -> dict:
     payload = {
         "model": model,
         "prompt": prompt,
-        "max_tokens": 1024,
-        "stream": False 
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {
+            "num_predict": 1024,
+            "temperature": 0,
+        },
     }
+    if response_format is not None:
+        # JSON-схема: Ollama ограничивает генерацию схемой и останавливается, когда объект закрыт
+        payload["format"] = response_format
+    return payload
+
+
+async def stream_ollama(prompt: str, model: str = OLLAMA_MODEL, response_format=None):
+    # отдаёт куски ответа по мере генерации
+    payload = _build_payload(prompt, model, response_format, stream=True)
+
+    try:
+        with span('llm', model=model, stream=True):
+            async with _get_client().stream("POST", "/api/generate", json=payload) as r:
+                r.raise_for_status()
+                async for line in r.aiter_lines():
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    if data.get('response'):
+                        yield data['response']
+                    if data.get('done'):
+                        _record_ollama_timings(data, model)
+                        break
+    except httpx.ConnectError:
+        raise ConnectionError(f"Не удалось подключиться к Ollama по адресу {OLLAMA_BASE}. Убедитесь, что Ollama запущен.")
+    except httpx.TimeoutException:
+        raise TimeoutError("Превышено время ожидания ответа от Ollama.")
+    except httpx.HTTPStatusError as e:
+        raise Exception(f"Ошибка HTTP от Ollama: {e.response.status_code}")
+
+
+async def ask_ollama(prompt: str, model: str = OLLAMA_MODEL, response_format=None):
+    payload = _build_payload(prompt, model, response_format, stream=False)
 
     try:
-        async with httpx.AsyncClient(timeout=220.0) as client:
-            r = await client.post(f"{OLLAMA_BASE}/api/generate", json=payload)
+        with span('llm', model=model):
+            r = await _get_client().post("/api/generate", json=payload)
             r.raise_for_status()
             data = r.json()
-            print(data)
-            return data
+        _record_ollama_timings(data, model)
+        return data
     except httpx.ConnectError:
         raise ConnectionError(f"Не удалось подключиться к Ollama по адресу {OLLAMA_BASE}. Убедитесь, что Ollama запущен.")
     except httpx.ReadTimeout:
@@ -36,14 +142,17 @@ async def ask_ollama(prompt: str, model: str = 'llama3'):
 async def assembly_request(user_prompt: str):
     system_instruction = get_system_prompt(user_prompt)
 
-    model_name = "llama3"
+    model_name = OLLAMA_MODEL
 
-    try:
-        answer = await ask_ollama(system_instruction, model=model_name)
+    async def request_plan():
+        answer = await ask_ollama(system_instruction, model=model_name, response_format=PLAN_SCHEMA)
         response_text = answer.get('response', '')
         if not response_text:
             raise ValueError("Ollama вернул пустой ответ")
         return {"response": response_text}
+
+    try:
+        return await get_or_create_plan(user_prompt, model_name, request_plan)
     except (ConnectionError, TimeoutError) as e:
         raise e
     except Exception as e:
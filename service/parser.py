@@ -1,9 +1,55 @@
+import asyncio
 import json
 import os
+import re
+from service.config import RENDER_MODE
+from service.effects import effects_label, part_effects
+from service.conform import conform_parts, conform_target, encoder_args
 from service.ffmpeg import cut_video_into_parts, merge_video_parts, replace_with_effect
+from service.metrics import annotate
+from service.probe import probe_media
+from service.render import (
+    can_render_single_pass, plan_segments_cached, render_plan, render_plan_segments, render_preview_source,
+)
 
 
-async def process_video_with_ffmpeg(video_path: str, command_json: dict):
+def _scrape_plan(response_str: str):
+    # запасной разбор для моделей, которые игнорируют format и пишут JSON в тексте
+    json_in_markdown = re.search(r'```(?:json)?\s*(\{.*?\})\s*```', response_str, re.DOTALL)
+    if json_in_markdown:
+        response_str = json_in_markdown.group(1)
+    else:
+        json_match_simple = re.search(r'\{[\s\S]*\}', response_str)
+        if json_match_simple:
+            response_str = json_match_simple.group(0)
+
+    response_str = response_str.replace('\n', ' ').replace('\r', ' ').strip()
+
+    try:
+        plan = json.loads(response_str)
+    except json.JSONDecodeError as e:
+        first_brace = response_str.find('{')
+        last_brace = response_str.rfind('}')
+        if first_brace != -1 and last_brace != -1 and last_brace > first_brace:
+            try:
+                json_str = response_str[first_brace:last_brace + 1]
+                plan = json.loads(json_str)
+            except Exception as parse_error:
+                json_match = re.search(r'\{[\s\S]*\}', response_str)
+                if json_match:
+                    try:
+                        plan = json.loads(json_match.group(0))
+                    except:
+                        return f"ошибка: неверный формат JSON от AI, ответ: {response_str[:200]}..."
+                else:
+                    return f"ошибка: неверный формат JSON от AI, ответ: {response_str[:200]}..."
+        else:
+            return f"ошибка: не найден JSON в ответе AI, ответ: {response_str[:200]}..."
+
+    return plan
+
+
+async def process_video_with_ffmpeg(video_path: str, command_json: dict, file_key: str = None, preview: bool = False):
     try:
         if not video_path or not os.path.exists(video_path):
             return ["ошибка: исходное видео не найдено"]
@@ -13,38 +59,13 @@ async def process_video_with_ffmpeg(video_path: str, command_json: dict):
         if not response_str:
             return ["ошибка: пустой ответ от AI"]
         
-        import re
-
-        json_in_markdown = re.search(r'```(?:json)?\s*(\{.*?\})\s*```', response_str, re.DOTALL)
-        if json_in_markdown:
-            response_str = json_in_markdown.group(1)
-        else:
-            json_match_simple = re.search(r'\{[\s\S]*\}', response_str)
-            if json_match_simple:
-                response_str = json_match_simple.group(0)
-        
-        response_str = response_str.replace('\n', ' ').replace('\r', ' ').strip()
-        
         try:
+            # Ollama отдаёт ответ по JSON-схеме, обычно он разбирается сразу
             plan = json.loads(response_str)
-        except json.JSONDecodeError as e:
-            first_brace = response_str.find('{')
-            last_brace = response_str.rfind('}')
-            if first_brace != -1 and last_brace != -1 and last_brace > first_brace:
-                try:
-                    json_str = response_str[first_brace:last_brace + 1]
-                    plan = json.loads(json_str)
-                except Exception as parse_error:
-                    json_match = re.search(r'\{[\s\S]*\}', response_str)
-                    if json_match:
-                        try:
-                            plan = json.loads(json_match.group(0))
-                        except:
-                            return [f"ошибка: неверный формат JSON от AI, ответ: {response_str[:200]}..."]
-                    else:
-                        return [f"ошибка: неверный формат JSON от AI, ответ: {response_str[:200]}..."]
-            else:
-                return [f"ошибка: не найден JSON в ответе AI, ответ: {response_str[:200]}..."]
+        except json.JSONDecodeError:
+            plan = _scrape_plan(response_str)
+            if isinstance(plan, str):
+                return [plan]
         
         parts = plan.get('parts', [])
         
@@ -53,16 +74,16 @@ async def process_video_with_ffmpeg(video_path: str, command_json: dict):
         
         print(f"DEBUG: Получен план монтажа с {len(parts)} частями")
         for i, part in enumerate(parts):
-            print(f"DEBUG: часть {i+1}: {part.get('start_sec')} - {part.get('end_sec')}, action={part.get('action')}, effect={part.get('effect_name')}")
+            print(f"DEBUG: часть {i+1}: {part.get('start_sec')} - {part.get('end_sec')}, action={part.get('action')}, effects={effects_label(part_effects(part))}")
         
+        media_info = None
+
         try:
-            import subprocess
-            cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', 
-                   '-of', 'default=noprint_wrappers=1:nokey=1', video_path]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            video_duration = float(result.stdout.strip())
+            media_info = await probe_media(video_path, file_key)
+            video_duration = media_info['duration']
             
             print(f"DEBUG: длительность видео: {video_duration} секунд")
+            annotate(video_duration=video_duration, parts=len(parts), render_mode=RENDER_MODE)
             
             parts.sort(key=lambda x: float(x.get('start_sec', 0)))
             
@@ -87,7 +108,55 @@ async def process_video_with_ffmpeg(video_path: str, command_json: dict):
         except:
             pass
         
-        cut_parts = await cut_video_into_parts(video_path, parts)
+        video_name = os.path.basename(video_path)
+        name_without_ext = os.path.splitext(video_name)[0]
+
+        if preview and media_info and can_render_single_pass(parts):
+            # превью одним проходом: уменьшение кадра до разбиения делает его дешёвым
+            final_video = await render_plan(video_path, parts, media_info, name_without_ext, preview=True)
+            return [final_video]
+
+        if preview:
+            # план с эффектами-вставками идёт старым путём, но по уменьшенной копии исходника,
+            # иначе под подписью превью получился бы полный рендер
+            preview_source = await render_preview_source(video_path, name_without_ext)
+            if preview_source.startswith("ошибка"):
+                return [preview_source]
+            video_path = preview_source
+            name_without_ext = f"{name_without_ext}_preview"
+            try:
+                media_info = await probe_media(video_path)
+            except Exception:
+                media_info = None
+
+        if RENDER_MODE == 'single_pass' and media_info and can_render_single_pass(parts):
+            # один проход - основной путь; склейка частей из кеша - только если все они там уже есть
+            if await plan_segments_cached(video_path, parts, media_info, file_key):
+                final_video = await render_plan_segments(video_path, parts, media_info, name_without_ext, file_key)
+            else:
+                final_video = await render_plan(video_path, parts, media_info, name_without_ext)
+            return [final_video]
+
+        # умная нарезка копирует поток без перекодирования, поэтому нужен исходник в том же кодеке, что и наш энкодер;
+        # у повёрнутого исходника скопированные куски теряют поворот, а перекодированные поворачиваются ffmpeg -
+        # кадры разного размера и ориентации, такие исходники режем с перекодированием
+        smart = (
+            RENDER_MODE == 'smart' and bool(media_info) and media_info.get('video_codec') == 'h264'
+            and (media_info.get('rotation') or 0) % 360 == 0
+        )
+
+        # все части кодируются в профиле и уровне задачи, тогда приведение перед склейкой их не трогает
+        target = conform_target(media_info) if media_info else None
+        encode_args = encoder_args(target) if target else None
+
+        cut_parts = await cut_video_into_parts(
+            video_path,
+            parts,
+            keyframes=media_info['keyframes'] if smart else None,
+            encode_args=encode_args,
+            # звук копируется только из AAC: куски на границах всегда кодируются в AAC
+            copy_audio=bool(media_info) and media_info.get('audio_codec') in (None, 'aac'),
+        )
         
         if isinstance(cut_parts, list) and len(cut_parts) > 0 and cut_parts[0].startswith("Ошибка"):
             return cut_parts
@@ -101,24 +170,33 @@ async def process_video_with_ffmpeg(video_path: str, command_json: dict):
                         pass
             return [f"ошибка: несоответствие количества частей (план: {len(parts)}, создано: {len(cut_parts)})"]
         
-        processed_parts = []
-        
-        for i, (part_info, part_path) in enumerate(zip(parts, cut_parts)):
-            if part_info.get('action') == 'edit':
-                effect_name = part_info.get('effect_name')
+        async def apply_effect(part_info: dict, part_path: str):
+            effects = part_effects(part_info)
+            if effects:
+                return await replace_with_effect(part_path, effects, encode_args)
+            return part_path
 
-                if effect_name:
-                    effect_path = await replace_with_effect(part_path, effect_name)
-                    processed_parts.append(effect_path)
-                else:
-                    processed_parts.append(part_path)
-            else:
-                processed_parts.append(part_path)
-        
-        video_name = os.path.basename(video_path)
-        name_without_ext = os.path.splitext(video_name)[0]
-        
-        final_video = await merge_video_parts(processed_parts, name_without_ext)
+        # эффекты на частях независимы и считаются параллельно, порядок частей сохраняется
+        processed_parts = list(await asyncio.gather(*[
+            apply_effect(part_info, part_path)
+            for part_info, part_path in zip(parts, cut_parts)
+        ]))
+        
+        # части из разных источников приводятся к параметрам исходника, склейка - копированием потоков
+        conformed_parts = await conform_parts(processed_parts, target) if target else None
+
+        final_video = None
+        if conformed_parts is not None:
+            final_video = await merge_video_parts(conformed_parts, name_without_ext, copy=True)
+            if final_video.startswith("ошибка"):
+                print(f"склейка копированием не удалась ({final_video}), склеиваем с перекодированием")
+                final_video = None
+        if final_video is None:
+            final_video = await merge_video_parts(processed_parts, name_without_ext)
+
+        for part in conformed_parts or []:
+            if part not in processed_parts and os.path.exists(part):
+                os.remove(part)
         
         if isinstance(final_video, str) and final_video.startswith("ошибка"):
             return [final_video]
@@ -1,23 +1,123 @@
 import asyncio
+import os
+import time
 from pathlib import Path
 from typing import Dict, List, Any
 from deep_translator import GoogleTranslator
 
 import aiohttp
 
+from service.cache import DiskCache, LRUCache, SingleFlight, evict_files, link_or_copy
+from service.config import CACHE_DIR, PEXELS_CACHE_TTL_SEC, PEXELS_LIBRARY_MAX_BYTES
+from service.metrics import inc
+from service.probe import probe_media
+
 PEXELS_VIDEO_SEARCH_URL = "https://api.pexels.com/videos/search"
 
-async def _translate_to_english(text: str) -> str:
+PEXELS_MAX_ATTEMPTS = 5
+PEXELS_LIBRARY_DIR = os.path.join(CACHE_DIR, "pexels")
+
+DOWNLOAD_CHUNK = 1024 * 1024
+DOWNLOAD_MAX_ATTEMPTS = 4
+
+_translator = None
+_translations_memory = LRUCache(1024)
+_translations_disk = DiskCache(os.path.join(CACHE_DIR, "translations.sqlite3"))
+_search_memory = LRUCache(512)
+_search_disk = DiskCache(os.path.join(CACHE_DIR, "pexels_search.sqlite3"), ttl=PEXELS_CACHE_TTL_SEC)
+_search_inflight = SingleFlight()
+_downloads = SingleFlight()
+
+
+def _normalize_text(text: str) -> str:
+    return " ".join(text.casefold().split())
+
 
-    def translate_sync():
+# Google Translate принимает до 5000 символов за запрос
+TRANSLATE_MAX_CHARS = 4500
+
+
+def _translation_chunks(texts: List[str]) -> List[List[str]]:
+    chunks, chunk, size = [], [], 0
+    for text in texts:
+        if chunk and size + len(text) + 1 > TRANSLATE_MAX_CHARS:
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(text)
+        size += len(text) + 1
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _translate_batch_sync(texts: List[str]) -> Dict[str, str]:
+    global _translator
+    if _translator is None:
+        _translator = GoogleTranslator(source="auto", target="en")
+
+    translations = {}
+    for chunk in _translation_chunks(texts):
+        # один запрос на пачку: описания идут строками, перевод сохраняет переносы
+        joined = "\n".join(" ".join(text.split()) for text in chunk)
         try:
-            return GoogleTranslator(source='auto', target='en').translate(text)
+            lines = (_translator.translate(joined) or "").split("\n")
+        except Exception as e:
+            print(f"ошибка пакетного перевода: {e}")
+            continue
+        if len(lines) == len(chunk):
+            translations.update(zip(chunk, (line.strip() for line in lines)))
+        else:
+            print(f"пакетный перевод вернул {len(lines)} строк вместо {len(chunk)}")
+
+    # по одному переводятся только те описания, которые не получились пачкой
+    for text in texts:
+        if translations.get(text):
+            continue
+        try:
+            translations[text] = _translator.translate(text)
         except Exception as e:
             print(f"ошибка перевода '{text}': {e}")
-            return text
+    return translations
+
+
+async def _translate_to_english(texts: List[str]) -> Dict[str, str]:
+    """
+    Переводит описания на английский с кешем в памяти и на диске.
+
+    Returns:
+        {исходный текст: перевод}; если перевести не удалось, остаётся исходный текст
+    """
+    result = {}
+    missing = []
+
+    for text in dict.fromkeys(texts):
+        key = _normalize_text(text)
+        translation = _translations_memory.get(key)
+        if translation is None:
+            translation = await _translations_disk.get(key)
+            if translation is not None:
+                _translations_memory.set(key, translation)
+
+        if translation is not None:
+            inc("translation_cache_total", result="hit")
+            result[text] = translation
+        else:
+            missing.append(text)
+
+    if missing:
+        inc("translation_cache_total", value=len(missing), result="miss")
+        translated = await asyncio.to_thread(_translate_batch_sync, missing)
+
+        for text in missing:
+            translation = translated.get(text)
+            if not translation:
+                result[text] = text
+                continue
+            key = _normalize_text(text)
+            _translations_memory.set(key, translation)
+            await _translations_disk.set(key, translation)
+            result[text] = translation
 
-    loop = asyncio.get_running_loop()
-    result = await loop.run_in_executor(None, translate_sync)
     return result
 
 
@@ -25,50 +125,142 @@ class PexelsAPIError(Exception):
     pass
 
 
-async def _search_best_video_url(
+def _retry_delay(resp: aiohttp.ClientResponse, attempt: int) -> float:
+    # Pexels сообщает, когда обнулится лимит; если не сообщил - экспоненциальная пауза
+    retry_after = resp.headers.get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    reset = resp.headers.get("X-Ratelimit-Reset")
+    if reset and reset.isdigit():
+        return min(max(float(reset) - time.time(), 1.0), 60.0)
+    return min(2 ** attempt, 60)
+
+
+async def _pexels_search(session: aiohttp.ClientSession, params: dict) -> Dict[str, Any]:
+    for attempt in range(1, PEXELS_MAX_ATTEMPTS + 1):
+        async with session.get(PEXELS_VIDEO_SEARCH_URL, params=params) as resp:
+            if resp.status == 200:
+                return await resp.json()
+
+            text = await resp.text()
+            if (resp.status == 429 or resp.status >= 500) and attempt < PEXELS_MAX_ATTEMPTS:
+                delay = _retry_delay(resp, attempt)
+                inc("pexels_retries_total", status=resp.status)
+                print(f"Pexels API вернул статус {resp.status}, повтор через {delay:.0f} с")
+            else:
+                raise PexelsAPIError(
+                    f"Pexels API вернул статус {resp.status}: {text}"
+                )
+
+        await asyncio.sleep(delay)
+
+
+async def _search_video(
     session: aiohttp.ClientSession,
     query: str,
-) -> str | None:
+) -> Dict[str, Any] | None:
+    # кешируется найденное видео со списком файлов, файл под нужное разрешение выбирается потом
+    key = _normalize_text(query)
+
+    video_data = _search_memory.get(key)
+    if video_data is None:
+        video_data = await _search_disk.get(key)
+    if video_data is not None:
+        inc("pexels_search_cache_total", result="hit")
+        _search_memory.set(key, video_data)
+        return video_data or None
+
+    inc("pexels_search_cache_total", result="shared" if key in _search_inflight else "miss")
+
+    async def search():
+        params = {
+            "query": query, 
+            "per_page": 1,   
+            "orientation": "landscape",
+            "size": "medium",    
+        }
+
+        data: Dict[str, Any] = await _pexels_search(session, params)
+
+        videos = data.get("videos") or []
+        # пустой результат тоже кешируем, чтобы не спрашивать снова
+        found = {"id": videos[0].get("id"), "video_files": videos[0].get("video_files") or []} if videos else {}
+        _search_memory.set(key, found)
+        await _search_disk.set(key, found)
+        return found
+
+    return await _search_inflight.do(key, search) or None
+
+
+def _pick_rendition(video_files: List[Dict[str, Any]], target: Dict[str, Any] | None) -> Dict[str, Any] | None:
+    """
+    Выбирает файл ролика под разрешение и fps основного видео.
+
+    Берётся самый маленький файл, у которого короткая сторона и fps не меньше, чем у основного видео.
+    Если такого нет (или основное видео неизвестно) - самый крупный.
+    """
+    files = [
+        f for f in video_files
+        if f.get("link") and f.get("width") and f.get("height")
+        and f.get("file_type", "video/mp4") == "video/mp4"
+    ]
+    if not files:
+        return None
 
-    trns_query = await _translate_to_english(query)
+    def size(f):
+        return f["width"] * f["height"], f.get("fps") or 0
 
-    params = {
-        "query": trns_query, 
-        "per_page": 1,   
-        "orientation": "landscape",
-        "size": "medium",    
-    }
+    if target:
+        # вставки горизонтальные, а основное видео может быть вертикальным - сравниваем короткие стороны
+        short_side = min(target["width"], target["height"])
+        fps = target.get("fps") or 0
+        suitable = [
+            f for f in files
+            if min(f["width"], f["height"]) >= short_side and (f.get("fps") or fps) >= fps - 0.5
+        ]
+        if suitable:
+            return min(suitable, key=size)
 
+    return max(files, key=size)
 
-    async with session.get(PEXELS_VIDEO_SEARCH_URL, params=params) as resp:
-        if resp.status != 200:
-            text = await resp.text()
-            raise PexelsAPIError(
-                f"Pexels API вернул статус {resp.status}: {text}"
-            )
 
-        data: Dict[str, Any] = await resp.json()
+async def _video_target(base_file_path: str) -> Dict[str, Any] | None:
+    if not os.path.exists(base_file_path):
+        return None
+    try:
+        info = await probe_media(base_file_path)
+    except Exception as e:
+        print(f"ошибка при получении параметров '{base_file_path}': {e}")
+        return None
+    if not info.get("width") or not info.get("height"):
+        return None
+    return {"width": info["width"], "height": info["height"], "fps": info.get("fps")}
+
+
+async def _search_best_video(
+    session: aiohttp.ClientSession,
+    query: str,
+    trns_query: str,
+    target: Dict[str, Any] | None,
+) -> tuple[int, Dict[str, Any]] | None:
 
-    videos = data.get("videos") or []
-    if not videos:
+    video_data = await _search_video(session, trns_query)
+    if not video_data:
         print(f"по запросу '{query}' видео не найдено")
         return None
 
-    video_data = videos[0]
     video_files = video_data.get("video_files") or []
 
     if not video_files:
         print(f"у найденного видео по запросу '{query}' нет поля 'video_files'")
         return None
 
-    video_files_sorted = sorted(
-        video_files,
-        key=lambda f: f.get("width", 0),
-        reverse=True,
-    )
+    best_file = _pick_rendition(video_files, target)
+    if best_file is None:
+        print(f"у найденного видео по запросу '{query}' нет подходящих файлов")
+        return None
 
-    best_file = video_files_sorted[0]
-    return best_file.get("link")
+    return video_data["id"], best_file
 
 
 async def _download_video(
@@ -77,39 +269,89 @@ async def _download_video(
     output_path: str,
 ) -> None:
 
-    async with session.get(url) as resp:
-        if resp.status != 200:
-            text = await resp.text()
-            raise RuntimeError(
-                f"ошибка скачивания '{url}': статус {resp.status}, тело: {text}"
-            )
+    # недокачанный файл остаётся в .part, следующая попытка продолжает его через Range
+    tmp_path = output_path + ".part"
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
 
-        Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    for attempt in range(1, DOWNLOAD_MAX_ATTEMPTS + 1):
+        offset = os.path.getsize(tmp_path) if os.path.exists(tmp_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
 
-        with open(output_path, "wb") as f:
-            async for chunk in resp.content.iter_chunked(1024 * 1024):
-                if not chunk:
-                    continue
-                f.write(chunk)
+        try:
+            async with session.get(url, headers=headers) as resp:
+                if resp.status == 416:
+                    # запрошенный диапазон за концом файла - всё уже скачано
+                    break
+                if resp.status not in (200, 206):
+                    text = await resp.text()
+                    raise RuntimeError(
+                        f"ошибка скачивания '{url}': статус {resp.status}, тело: {text}"
+                    )
+
+                if offset and resp.status == 206:
+                    inc("pexels_download_resumed_total")
+                # сервер без поддержки Range отдаёт файл целиком - пишем заново
+                mode = "ab" if resp.status == 206 else "wb"
+
+                with open(tmp_path, mode) as f:
+                    async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK):
+                        if not chunk:
+                            continue
+                        await asyncio.to_thread(f.write, chunk)
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == DOWNLOAD_MAX_ATTEMPTS:
+                raise RuntimeError(f"ошибка скачивания '{url}': {e}") from e
+            print(f"обрыв скачивания '{url}', продолжаем: {e}")
+            await asyncio.sleep(min(2 ** attempt, 30))
+
+    os.replace(tmp_path, output_path)
+
+
+async def _library_clip(
+    session: aiohttp.ClientSession,
+    video_id: int,
+    video_file: Dict[str, Any],
+) -> str:
+    # библиотека стоковых роликов: файл Pexels скачивается один раз
+    library_path = os.path.join(PEXELS_LIBRARY_DIR, f"{video_id}_{video_file.get('id') or video_file['width']}.mp4")
+
+    if os.path.exists(library_path):
+        inc("pexels_library_total", result="hit")
+        os.utime(library_path)
+        return library_path
+
+    inc("pexels_library_total", result="shared" if library_path in _downloads else "miss")
+
+    async def download():
+        await _download_video(session, video_file["link"], library_path)
+        await asyncio.to_thread(evict_files, PEXELS_LIBRARY_DIR, PEXELS_LIBRARY_MAX_BYTES, library_path)
+        return library_path
+
+    return await _downloads.do(library_path, download)
 
 
 async def _process_single_insert(
     session: aiohttp.ClientSession,
     base_file_path: str,
     description: str,
+    trns_query: str,
 ) -> str:
 
     path = Path(base_file_path)
 
     output_path = str(path.with_stem(path.stem + "_vstavka"))
 
-    video_url = await _search_best_video_url(session, description)
-    if not video_url:
+    target = await _video_target(base_file_path)
+    found = await _search_best_video(session, description, trns_query, target)
+    if not found:
         raise RuntimeError(
             f"не удалось найти видео по описанию '{description}' для файла '{base_file_path}'"
         )
 
-    await _download_video(session, video_url, output_path)
+    video_id, video_file = found
+    library_path = await _library_clip(session, video_id, video_file)
+    await asyncio.to_thread(link_or_copy, library_path, output_path)
 
     print(f"вставка для '{base_file_path}' сохранена в '{output_path}'")
     return output_path
@@ -124,6 +366,9 @@ async def process_inserts(
         "Authorization": pexels_api_key
     }
 
+    # все описания переводятся одним пакетом, повторяющиеся - один раз
+    translations = await _translate_to_english(list(inserts.values()))
+
     async with aiohttp.ClientSession(headers=headers) as session:
         tasks = []
 
@@ -132,6 +377,7 @@ async def process_inserts(
                 session=session,
                 base_file_path=base_file_path,
                 description=description,
+                trns_query=translations[description],
             )
             tasks.append(task)
 
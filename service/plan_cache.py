@@ -0,0 +1,72 @@
+import hashlib
+import os
+import re
+import unicodedata
+
+from service.cache import DiskCache, LRUCache, SingleFlight
+from service.config import CACHE_DIR, PLAN_CACHE_MAX_BYTES, PLAN_CACHE_MEMORY_SIZE, PLAN_CACHE_TTL_SEC
+from service.metrics import inc
+from service.prompts import PROMPT_VERSION
+
+
+_memory = LRUCache(PLAN_CACHE_MEMORY_SIZE)
+_disk = DiskCache(os.path.join(CACHE_DIR, 'plans.sqlite3'), ttl=PLAN_CACHE_TTL_SEC, max_bytes=PLAN_CACHE_MAX_BYTES)
+_inflight = SingleFlight()
+
+
+def normalize_prompt(prompt: str) -> str:
+    # "Размыть первые 10 секунд!" и "размыть  первые 10 секунд" дают один и тот же план
+    text = unicodedata.normalize('NFKC', prompt).casefold().replace('ё', 'е')
+    text = re.sub(r'[^\w\s%.,]', ' ', text)
+    # точка и запятая значимы только как десятичный разделитель
+    text = re.sub(r'(?<!\d)[.,]|[.,](?!\d)', ' ', text)
+    return ' '.join(text.split())
+
+
+def plan_cache_key(prompt: str, model: str) -> str:
+    raw = f"{model}|{PROMPT_VERSION}|{normalize_prompt(prompt)}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+async def get_cached_plan(prompt: str, model: str):
+    key = plan_cache_key(prompt, model)
+
+    plan = _memory.get(key)
+    if plan is not None:
+        inc('plan_cache_total', result='memory')
+        return plan
+
+    plan = await _disk.get(key)
+    if plan is not None:
+        inc('plan_cache_total', result='disk')
+        _memory.set(key, plan)
+        return plan
+
+    return None
+
+
+async def store_plan(prompt: str, model: str, plan):
+    key = plan_cache_key(prompt, model)
+    _memory.set(key, plan)
+    await _disk.set(key, plan)
+
+
+async def get_or_create_plan(prompt: str, model: str, create):
+    key = plan_cache_key(prompt, model)
+
+    plan = await get_cached_plan(prompt, model)
+    if plan is not None:
+        return plan
+
+    if key in _inflight:
+        inc('plan_cache_total', result='shared')
+    else:
+        inc('plan_cache_total', result='miss')
+
+    async def create_and_store():
+        result = await create()
+        await store_plan(prompt, model, result)
+        return result
+
+    # одинаковые запросы, пришедшие одновременно, ждут один вызов LLM
+    return await _inflight.do(key, create_and_store)
@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+from array import array
+
+from service.cache import LRUCache, SingleFlight
+from service.config import CACHE_DIR
+from service.metrics import inc, span
+
+
+PROBE_CACHE_DIR = os.path.join(CACHE_DIR, 'probe')
+
+_memory_cache = LRUCache(256)
+_inflight = SingleFlight()
+
+
+def file_fingerprint(video_path: str) -> str:
+    # хеш размера и первого/последнего мегабайта: быстро и достаточно для идентификации файла
+    size = os.path.getsize(video_path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(video_path, 'rb') as f:
+        digest.update(f.read(1024 * 1024))
+        if size > 2 * 1024 * 1024:
+            f.seek(-1024 * 1024, os.SEEK_END)
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def file_sha256(path: str) -> str:
+    # полный хеш содержимого - для кешей, где совпадение ключа отдаёт чужой платный результат
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _parse_rate(rate: str):
+    try:
+        num, _, den = (rate or '').partition('/')
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def _rotation(stream: dict) -> int:
+    rotate = stream.get('tags', {}).get('rotate')
+    if rotate is not None:
+        return int(float(rotate))
+    for side_data in stream.get('side_data_list', []):
+        if 'rotation' in side_data:
+            return int(float(side_data['rotation']))
+    return 0
+
+
+async def _run_ffprobe(video_path: str) -> dict:
+    # одним запуском: формат, потоки и заголовки пакетов (флаги ключевых кадров)
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-show_entries',
+        'format=duration,size,bit_rate'
+        ':stream=index,codec_type,codec_name,profile,level,width,height,pix_fmt,r_frame_rate,sample_rate,channels'
+        ':stream_tags=rotate:stream_side_data=rotation'
+        ':packet=stream_index,pts_time,flags',
+        '-of', 'json',
+        video_path
+    ]
+
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+
+    stdout, stderr = await process.communicate()
+
+    if process.returncode != 0:
+        raise RuntimeError(f'ошибка ffprobe: {stderr.decode()}')
+
+    return json.loads(stdout.decode() or '{}')
+
+
+def _build_info(data: dict):
+    streams = data.get('streams', [])
+    video_stream = next((s for s in streams if s.get('codec_type') == 'video'), {})
+    audio_stream = next((s for s in streams if s.get('codec_type') == 'audio'), {})
+    video_index = video_stream.get('index')
+
+    keyframes = array('d', sorted(
+        float(p['pts_time'])
+        for p in data.get('packets', [])
+        if p.get('stream_index') == video_index and 'K' in p.get('flags', '') and p.get('pts_time') not in (None, 'N/A')
+    ))
+
+    info = {
+        'duration': float(data.get('format', {}).get('duration', 0)),
+        'size': int(data.get('format', {}).get('size', 0)),
+        'width': video_stream.get('width'),
+        'height': video_stream.get('height'),
+        'video_codec': video_stream.get('codec_name'),
+        'video_profile': video_stream.get('profile'),
+        'video_level': video_stream.get('level'),
+        'pix_fmt': video_stream.get('pix_fmt'),
+        'fps': _parse_rate(video_stream.get('r_frame_rate')),
+        'rotation': _rotation(video_stream),
+        'has_audio': bool(audio_stream),
+        'audio_codec': audio_stream.get('codec_name'),
+        'sample_rate': int(audio_stream['sample_rate']) if audio_stream.get('sample_rate') else None,
+        'channels': audio_stream.get('channels'),
+        'streams': [
+            {k: v for k, v in s.items() if k not in ('tags', 'side_data_list')}
+            for s in streams
+        ],
+    }
+    return info, keyframes
+
+
+def _cache_paths(key: str):
+    return os.path.join(PROBE_CACHE_DIR, f'{key}.json'), os.path.join(PROBE_CACHE_DIR, f'{key}.kf')
+
+
+def _map_keyframes(path: str):
+    # индекс ключевых кадров - плоский массив float64, читаем его через mmap без загрузки в память
+    if os.path.getsize(path) == 0:
+        return array('d')
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped).cast('d')
+
+
+def _load_from_disk(key: str):
+    info_path, keyframes_path = _cache_paths(key)
+    if not os.path.exists(info_path) or not os.path.exists(keyframes_path):
+        return None
+    with open(info_path, 'r', encoding='utf-8') as f:
+        info = json.load(f)
+    if 'video_profile' not in info:
+        # запись от старой версии без профиля и уровня кодека - пробуем заново
+        return None
+    info['keyframes'] = _map_keyframes(keyframes_path)
+    return info
+
+
+def _save_to_disk(key: str, info: dict, keyframes: array):
+    os.makedirs(PROBE_CACHE_DIR, exist_ok=True)
+    info_path, keyframes_path = _cache_paths(key)
+    with open(keyframes_path + '.tmp', 'wb') as f:
+        keyframes.tofile(f)
+    os.replace(keyframes_path + '.tmp', keyframes_path)
+    with open(info_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(info, f)
+    os.replace(info_path + '.tmp', info_path)
+
+
+async def probe_media(video_path: str, file_key: str = None) -> dict:
+    key = file_key or await asyncio.to_thread(file_fingerprint, video_path)
+
+    info = _memory_cache.get(key)
+    if info is not None:
+        inc('probe_cache_total', result='memory')
+        return info
+
+    async def load():
+        info = await asyncio.to_thread(_load_from_disk, key)
+        if info is not None:
+            inc('probe_cache_total', result='disk')
+        else:
+            inc('probe_cache_total', result='miss')
+            with span('probe'):
+                data = await _run_ffprobe(video_path)
+            info, keyframes = _build_info(data)
+            await asyncio.to_thread(_save_to_disk, key, info, keyframes)
+            info['keyframes'] = keyframes
+
+        _memory_cache.set(key, info)
+        return info
+
+    # одновременные пробы одного файла выполняются один раз
+    if key in _inflight:
+        inc('probe_cache_total', result='shared')
+    return await _inflight.do(key, load)
@@ -1,11 +1,22 @@
 """
 Промпты для AI модели (Ollama) для обработки запросов пользователей о монтаже видео.
 """
+import hashlib
+import os
+
+# эффекты-вставки: часть заменяется готовым клипом из папки effects/ (service/ffmpeg.py);
+# "transition" берёт первый клип, остальные имена - файлы из папки без расширения
+EFFECTS_DIR = 'effects'
+INSERT_EFFECT_NAMES = ['transition'] + sorted(
+    os.path.splitext(name)[0]
+    for name in (os.listdir(EFFECTS_DIR) if os.path.isdir(EFFECTS_DIR) else [])
+    if name.endswith('.mp4') and os.path.splitext(name)[0] != 'transition'
+)
 
 # Базовый промпт для понимания запросов пользователей
 VIDEO_EDITING_PROMPT = """Ты профессиональный AI-ассистент для монтажа видео. Твоя задача - понимать запросы пользователей и преобразовывать их в технический план монтажа.
 
-ДОСТУПНЫЕ ЭФФЕКТЫ (effect_name) - ИСПОЛЬЗУЙ ТОЛЬКО ЭТИ ЭФФЕКТЫ:
+ДОСТУПНЫЕ ЭФФЕКТЫ (name в списке effects) - ИСПОЛЬЗУЙ ТОЛЬКО ЭТИ ЭФФЕКТЫ:
 
 1. **darken** - затемнение видео
    Синонимы: затемнить, затемнение, сделать темнее, затемни, затемни на X%
@@ -62,7 +73,11 @@ VIDEO_EDITING_PROMPT = """Ты профессиональный AI-ассист
 18. **invert** - инверсия цветов
     Синонимы: инверсия, негатив, invert, негативное изображение
 
-ВАЖНО: Используй ТОЛЬКО эти 18 эффектов. Если пользователь просит эффект, которого нет в списке, выбери ближайший по смыслу из доступных.
+19. **transition** - переход: часть заменяется готовым клипом из папки effects/
+    Синонимы: переход, добавь переход, вставка перехода
+    Конкретный клип из effects/ указывается его именем: __INSERT_EFFECTS__
+
+ВАЖНО: Используй ТОЛЬКО эти 19 эффектов. Если пользователь просит эффект, которого нет в списке, выбери ближайший по смыслу из доступных.
 
 ПРАВИЛА ОБРАБОТКИ ЗАПРОСОВ:
 
@@ -75,13 +90,15 @@ VIDEO_EDITING_PROMPT = """Ты профессиональный AI-ассист
    - "с X секунды" → start_sec=X, end_sec=длительность
 
 2. **Проценты и параметры:**
-   - "на 50%" → параметр эффекта = 0.5
-   - "на 30%" → параметр эффекта = 0.3
-   - "сильно" → увеличить параметр эффекта
-   - "слабо" → уменьшить параметр эффекта
+   - "на 50%" → intensity = 0.5
+   - "на 30%" → intensity = 0.3
+   - "сильно" → увеличить intensity
+   - "слабо" → уменьшить intensity
+   - Если сила эффекта не указана → intensity = null (значение по умолчанию)
+   - Для slow_motion и fast_motion intensity - это скорость: "в 2 раза медленнее" → 0.5, "в 3 раза быстрее" → 3
 
 3. **Комбинации эффектов:**
-   - Если пользователь просит несколько эффектов на одном отрезке, выбери основной эффект
+   - Если пользователь просит несколько эффектов на одном отрезке, перечисли ВСЕ в списке effects этой части в порядке применения
    - Если эффекты на разных отрезках - создай отдельные части для каждого
 
 4. **Синонимы и варианты запросов:**
@@ -104,29 +121,34 @@ VIDEO_EDITING_PROMPT = """Ты профессиональный AI-ассист
    - Части НЕ должны иметь пропусков
 
 ФОРМАТ ОТВЕТА (строго JSON):
-{{"parts": [{{"start_sec": число, "end_sec": число, "action": "keep" или "edit", "effect_name": "название_эффекта" или null}}]}}
+{{"parts": [{{"start_sec": число, "end_sec": число, "action": "keep" или "edit", "effects": [{{"name": "название_эффекта", "intensity": число или null}}]}}]}}
+У частей с action="keep" список effects пустой.
 
 ПРИМЕРЫ:
 
 Пример 1:
 Запрос: "нужно чтобы ты с 5 по 10 секунду добавил затемнение на 50%"
-Ответ: {{"parts": [{{"start_sec": 0, "end_sec": 5, "action": "keep", "effect_name": null}}, {{"start_sec": 5, "end_sec": 10, "action": "edit", "effect_name": "darken"}}, {{"start_sec": 10, "end_sec": 30, "action": "keep", "effect_name": null}}]}}
+Ответ: {{"parts": [{{"start_sec": 0, "end_sec": 5, "action": "keep", "effects": []}}, {{"start_sec": 5, "end_sec": 10, "action": "edit", "effects": [{{"name": "darken", "intensity": 0.5}}]}}, {{"start_sec": 10, "end_sec": 30, "action": "keep", "effects": []}}]}}
 
 Пример 2:
 Запрос: "сделай чёрно-белый эффект с 5 до 15 секунд"
-Ответ: {{"parts": [{{"start_sec": 0, "end_sec": 5, "action": "keep", "effect_name": null}}, {{"start_sec": 5, "end_sec": 15, "action": "edit", "effect_name": "black_white"}}, {{"start_sec": 15, "end_sec": 30, "action": "keep", "effect_name": null}}]}}
+Ответ: {{"parts": [{{"start_sec": 0, "end_sec": 5, "action": "keep", "effects": []}}, {{"start_sec": 5, "end_sec": 15, "action": "edit", "effects": [{{"name": "black_white", "intensity": null}}]}}, {{"start_sec": 15, "end_sec": 30, "action": "keep", "effects": []}}]}}
 
 Пример 3:
 Запрос: "размыть первые 10 секунд"
-Ответ: {{"parts": [{{"start_sec": 0, "end_sec": 10, "action": "edit", "effect_name": "blur"}}, {{"start_sec": 10, "end_sec": 30, "action": "keep", "effect_name": null}}]}}
+Ответ: {{"parts": [{{"start_sec": 0, "end_sec": 10, "action": "edit", "effects": [{{"name": "blur", "intensity": null}}]}}, {{"start_sec": 10, "end_sec": 30, "action": "keep", "effects": []}}]}}
 
 Пример 4:
 Запрос: "замедли видео с 20 по 25 секунду"
-Ответ: {{"parts": [{{"start_sec": 0, "end_sec": 20, "action": "keep", "effect_name": null}}, {{"start_sec": 20, "end_sec": 25, "action": "edit", "effect_name": "slow_motion"}}, {{"start_sec": 25, "end_sec": 30, "action": "keep", "effect_name": null}}]}}
+Ответ: {{"parts": [{{"start_sec": 0, "end_sec": 20, "action": "keep", "effects": []}}, {{"start_sec": 20, "end_sec": 25, "action": "edit", "effects": [{{"name": "slow_motion", "intensity": null}}]}}, {{"start_sec": 25, "end_sec": 30, "action": "keep", "effects": []}}]}}
 
 Пример 5:
 Запрос: "осветли видео на 30% с 0 по 15 секунду"
-Ответ: {{"parts": [{{"start_sec": 0, "end_sec": 15, "action": "edit", "effect_name": "brighten"}}, {{"start_sec": 15, "end_sec": 30, "action": "keep", "effect_name": null}}]}}
+Ответ: {{"parts": [{{"start_sec": 0, "end_sec": 15, "action": "edit", "effects": [{{"name": "brighten", "intensity": 0.3}}]}}, {{"start_sec": 15, "end_sec": 30, "action": "keep", "effects": []}}]}}
+
+Пример 6:
+Запрос: "сделай чёрно-белое и замедли с 10 по 20 секунду"
+Ответ: {{"parts": [{{"start_sec": 0, "end_sec": 10, "action": "keep", "effects": []}}, {{"start_sec": 10, "end_sec": 20, "action": "edit", "effects": [{{"name": "black_white", "intensity": null}}, {{"name": "slow_motion", "intensity": null}}]}}, {{"start_sec": 20, "end_sec": 30, "action": "keep", "effects": []}}]}}
 
 КРИТИЧЕСКИ ВАЖНО:
 - Возвращай ТОЛЬКО валидный JSON
@@ -137,6 +159,49 @@ VIDEO_EDITING_PROMPT = """Ты профессиональный AI-ассист
 - start_sec всегда меньше end_sec
 - Части покрывают ВСЁ видео без пропусков
 """
+VIDEO_EDITING_PROMPT = VIDEO_EDITING_PROMPT.replace(
+    '__INSERT_EFFECTS__', ', '.join(INSERT_EFFECT_NAMES[1:]) or 'других клипов нет'
+)
+
+EFFECT_NAMES = [
+    "darken", "brighten", "black_white", "saturate", "desaturate", "blur",
+    "sharpen", "contrast", "zoom_in", "zoom_out", "slow_motion", "fast_motion",
+    "rotate", "flip_horizontal", "flip_vertical", "vignette", "sepia", "invert",
+]
+
+# JSON-схема ответа для параметра format в Ollama
+PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "parts": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "start_sec": {"type": "number"},
+                    "end_sec": {"type": "number"},
+                    "action": {"type": "string", "enum": ["keep", "edit"]},
+                    "effects": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "name": {"type": "string", "enum": EFFECT_NAMES + INSERT_EFFECT_NAMES},
+                                "intensity": {"type": ["number", "null"]},
+                            },
+                            "required": ["name", "intensity"],
+                        },
+                    },
+                },
+                "required": ["start_sec", "end_sec", "action", "effects"],
+            },
+        },
+    },
+    "required": ["parts"],
+}
+
+# Версия шаблона для ключей кеша планов: меняется автоматически при любой правке промпта
+PROMPT_VERSION = hashlib.sha1(VIDEO_EDITING_PROMPT.encode()).hexdigest()[:12]
 
 
 def get_system_prompt(user_prompt: str) -> str:
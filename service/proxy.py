@@ -0,0 +1,153 @@
+"""
+Прокси-копии исходников для загрузки во внешние AI-сервисы.
+
+Gemini и Runway не нужны пиксели сверх того, что они реально используют: Runway отдаёт
+результат в одном из ALLOWED_RATIOS, Gemini сам выбирает кадры с ограниченной частотой.
+Прокси уменьшается, пережимается в компактный битрейт и кешируется
+по отпечатку исходника и параметрам.
+"""
+import asyncio
+import hashlib
+import os
+
+from service.cache import SingleFlight, evict_files
+from service.config import CACHE_DIR, PROXY_CACHE_MAX_BYTES
+from service.ffmpeg import THREADS_ARGS, run_ffmpeg
+from service.metrics import inc, span
+from service.probe import file_fingerprint, probe_media
+
+
+PROXY_CACHE_DIR = os.path.join(CACHE_DIR, 'proxy')
+
+# для анализа стиля: 1280 пикселей по большей стороне и битрейт, при котором не плывут цвета и мелкий текст
+# субтитров; 10 кадров в секунду хватает для таймингов переходов и анимаций. Разрешение и fps
+# исходника передаются Gemini отдельно (video_analiz.SOURCE_PROMPT)
+ANALYSIS_PROXY = {"max_width": 1280, "max_height": 1280, "fps": 10, "video_bitrate": '2500k', "audio_bitrate": '128k'}
+# для Runway размер берётся из выбранного соотношения сторон, частота кадров сохраняется
+RUNWAY_PROXY = {"video_bitrate": '4M', "audio_bitrate": '128k'}
+
+_inflight = SingleFlight()
+
+
+def _bitrate_bits(bitrate: str) -> int:
+    multipliers = {'k': 1000, 'M': 1000 * 1000}
+    if bitrate[-1] in multipliers:
+        return int(float(bitrate[:-1]) * multipliers[bitrate[-1]])
+    return int(bitrate)
+
+
+def _display_size(media_info: dict):
+    width, height = media_info.get('width'), media_info.get('height')
+    if abs(media_info.get('rotation') or 0) % 180 == 90:
+        width, height = height, width
+    return width, height
+
+
+def _needs_proxy(media_info: dict, max_width: int, max_height: int, fps: float, video_bitrate: str) -> bool:
+    width, height = _display_size(media_info)
+    if not width or not height or not media_info.get('duration'):
+        return True
+    if width > max_width or height > max_height:
+        return True
+    if fps and (media_info.get('fps') or 0) > fps:
+        return True
+    # исходник и так маленький: пережатие только потеряет качество
+    bitrate = media_info.get('size', 0) * 8 / media_info['duration']
+    return bitrate > _bitrate_bits(video_bitrate) * 1.5
+
+
+async def make_proxy(
+        video_path: str,
+        max_width: int = None,
+        max_height: int = None,
+        fps: float = None,
+        video_bitrate: str = '2M',
+        audio_bitrate: str = '128k',
+        file_key: str = None,
+) -> str:
+    """
+    Уменьшенная копия видео для загрузки во внешний сервис.
+
+    Args:
+        video_path: Исходное видео
+        max_width, max_height: Кадр вписывается в эти размеры с сохранением пропорций
+        fps: Частота кадров прокси (None - как у исходника)
+        video_bitrate, audio_bitrate: Битрейт прокси
+        file_key: Ключ исходника, если он уже известен (file_unique_id)
+
+    Returns:
+        Путь к прокси или к исходнику, если он уже не больше нужного
+    """
+    media_info = await probe_media(video_path, file_key)
+    source_width, source_height = _display_size(media_info)
+    max_width = max_width or source_width
+    max_height = max_height or source_height
+
+    if not _needs_proxy(media_info, max_width, max_height, fps, video_bitrate):
+        inc('proxy_total', result='source')
+        return video_path
+
+    source_key = file_key or await asyncio.to_thread(file_fingerprint, video_path)
+    params = f'{max_width}x{max_height}|{fps}|{video_bitrate}|{audio_bitrate}'
+    key = hashlib.sha1(f'{source_key}|{params}'.encode()).hexdigest()[:20]
+    proxy_path = os.path.join(PROXY_CACHE_DIR, f'{key}.mp4')
+
+    if os.path.exists(proxy_path):
+        inc('proxy_total', result='hit')
+        os.utime(proxy_path)
+        return proxy_path
+
+    inc('proxy_total', result='shared' if key in _inflight else 'miss')
+
+    async def create():
+        os.makedirs(PROXY_CACHE_DIR, exist_ok=True)
+        tmp_path = os.path.join(PROXY_CACHE_DIR, f'{key}_{os.getpid()}.tmp.mp4')
+
+        video_filters = [
+            f'scale={max_width}:{max_height}:force_original_aspect_ratio=decrease',
+            'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+        ]
+        if fps:
+            video_filters.append(f'fps={fps}')
+
+        cmd = [
+            'ffmpeg',
+            '-i', video_path,
+            '-vf', ','.join(video_filters),
+            '-c:v', 'libx264',
+            '-preset', 'veryfast',
+            '-b:v', video_bitrate,
+            '-maxrate', video_bitrate,
+            '-bufsize', video_bitrate,
+            '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac',
+            '-b:a', audio_bitrate,
+            '-movflags', '+faststart',
+            *THREADS_ARGS,
+            '-y', tmp_path
+        ]
+
+        try:
+            with span('proxy', params=params):
+                returncode, stderr = await run_ffmpeg(cmd)
+
+            if returncode != 0 or not os.path.exists(tmp_path):
+                raise RuntimeError(f'ошибка FFmpeg при создании прокси: {stderr.decode()[-1000:]}')
+
+            os.replace(tmp_path, proxy_path)
+            await asyncio.to_thread(evict_files, PROXY_CACHE_DIR, PROXY_CACHE_MAX_BYTES, proxy_path)
+            return proxy_path
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    return await _inflight.do(key, create)
+
+
+async def analysis_proxy(video_path: str, file_key: str = None) -> str:
+    return await make_proxy(video_path, file_key=file_key, **ANALYSIS_PROXY)
+
+
+async def runway_proxy(video_path: str, ratio: str, file_key: str = None) -> str:
+    width, height = (int(side) for side in ratio.split(':'))
+    return await make_proxy(video_path, max_width=width, max_height=height, file_key=file_key, **RUNWAY_PROXY)
@@ -0,0 +1,277 @@
+import asyncio
+import os
+
+from service.config import PREVIEW_FPS, PREVIEW_HEIGHT
+from service.effects import build_effect_chain, effects_label, is_filter_effect, part_effects, prepare_color_luts
+from service.ffmpeg import THREADS_ARGS, merge_video_parts, run_ffmpeg
+from service.metrics import span
+from service.render_cache import cached_segment, is_segment_cached, render_cache_enabled, segment_key
+
+
+# параметры кодирования частей: одинаковые у всех частей, чтобы склеивать их без перекодирования
+SEGMENT_VIDEO_ARGS = ['-c:v', 'libx264', '-pix_fmt', 'yuv420p']
+SEGMENT_AUDIO_ARGS = ['-c:a', 'aac']
+
+# превью нужно только чтобы проверить монтаж: быстрый пресет и низкое качество
+PREVIEW_VIDEO_ARGS = ['-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '30', '-pix_fmt', 'yuv420p']
+PREVIEW_AUDIO_ARGS = ['-c:a', 'aac', '-b:a', '64k']
+
+
+def can_render_single_pass(parts: list) -> bool:
+    # эффекты-вставки из папки effects/ подменяют часть другим файлом,
+    # такие планы собираются старым путём через нарезку и склейку
+    for part in parts:
+        for effect in part_effects(part):
+            if not is_filter_effect(effect['name']):
+                return False
+    return True
+
+
+def _display_size(media_info: dict):
+    width = media_info.get('width')
+    height = media_info.get('height')
+    if abs(media_info.get('rotation') or 0) % 180 == 90:
+        # ffmpeg применяет поворот из метаданных при декодировании
+        width, height = height, width
+    return width, height
+
+
+def preview_media_info(media_info: dict) -> dict:
+    # размеры кадра превью уже после поворота, дальше фильтры работают с ними
+    width, height = _display_size(media_info)
+    if width and height and height > PREVIEW_HEIGHT:
+        width = max(2, round(width * PREVIEW_HEIGHT / height / 2) * 2)
+        height = PREVIEW_HEIGHT
+    return {**media_info, 'width': width, 'height': height, 'rotation': 0}
+
+
+def effect_filters(part: dict, media_info: dict) -> tuple[list, list]:
+    effects = part_effects(part)
+    chain = build_effect_chain(effects)
+    video_filters = chain['video']
+
+    if chain['geometry']:
+        width, height = _display_size(media_info)
+        if width and height:
+            # поворот и зум меняют размер кадра, а склейка требует одинаковых размеров
+            video_filters.append(
+                f'scale={width}:{height}:force_original_aspect_ratio=decrease,'
+                f'pad={width}:{height}:(ow-iw)/2:(oh-ih)/2'
+            )
+
+    video_filters.append('setsar=1')
+    return video_filters, chain['audio']
+
+
+def build_filter_graph(parts: list, media_info: dict, source_filters: list = None) -> tuple[str, list]:
+    count = len(parts)
+    has_audio = media_info.get('has_audio', False)
+
+    # source_filters применяются к исходнику один раз до разбиения на части (уменьшение для превью)
+    source_chain = ','.join(source_filters or []) + (',' if source_filters else '')
+    chains = ['[0:v]' + source_chain + 'split=' + str(count) + ''.join(f'[sv{i}]' for i in range(count))]
+    if has_audio:
+        chains.append('[0:a]asplit=' + str(count) + ''.join(f'[sa{i}]' for i in range(count)))
+
+    concat_inputs = []
+
+    for i, part in enumerate(parts):
+        start_sec = float(part.get('start_sec', 0))
+        end_sec = float(part.get('end_sec', 0))
+        video_effect, audio_effect = effect_filters(part, media_info)
+
+        video_filters = [f'trim=start={start_sec}:end={end_sec}', 'setpts=PTS-STARTPTS', *video_effect]
+        chains.append(f'[sv{i}]' + ','.join(video_filters) + f'[v{i}]')
+        concat_inputs.append(f'[v{i}]')
+
+        if has_audio:
+            audio_filters = [f'atrim=start={start_sec}:end={end_sec}', 'asetpts=PTS-STARTPTS', *audio_effect]
+            chains.append(f'[sa{i}]' + ','.join(audio_filters) + f'[a{i}]')
+            concat_inputs.append(f'[a{i}]')
+
+    audio_flag = 1 if has_audio else 0
+    chains.append(''.join(concat_inputs) + f'concat=n={count}:v=1:a={audio_flag}[outv]' + ('[outa]' if has_audio else ''))
+
+    maps = ['-map', '[outv]']
+    if has_audio:
+        maps += ['-map', '[outa]']
+
+    return ';'.join(chains), maps
+
+
+def _segment_command(video_path: str, part: dict, media_info: dict, source_key: str = None):
+    # (команда ffmpeg без выхода, ключ части в кеше или None); LUT эффектов уже посчитаны
+    start_sec = float(part.get('start_sec', 0))
+    end_sec = float(part.get('end_sec', 0))
+    video_filters, audio_filters = effect_filters(part, media_info)
+
+    cmd = [
+        'ffmpeg',
+        '-ss', str(start_sec),
+        '-i', video_path,
+        '-t', str(end_sec - start_sec),
+        '-vf', ','.join(video_filters),
+        *SEGMENT_VIDEO_ARGS,
+    ]
+    if media_info.get('has_audio'):
+        if audio_filters:
+            cmd += ['-af', ','.join(audio_filters)]
+        cmd += SEGMENT_AUDIO_ARGS
+
+    if not render_cache_enabled(source_key):
+        return cmd, None
+
+    encoder_args = SEGMENT_VIDEO_ARGS + (SEGMENT_AUDIO_ARGS if media_info.get('has_audio') else [])
+    return cmd, segment_key(source_key, start_sec, end_sec, video_filters, audio_filters, encoder_args)
+
+
+async def render_segment(video_path: str, part: dict, media_info: dict, output_path: str, source_key: str = None) -> bool:
+    # одна часть плана прямо из исходника: перемотка, фильтры эффекта и кодирование за один запуск
+    await prepare_color_luts([part_effects(part)])
+    cmd, key = _segment_command(video_path, part, media_info, source_key)
+
+    if key is None:
+        return await _encode_segment(cmd, part, output_path)
+    return await cached_segment(key, output_path, lambda path: _encode_segment(cmd, part, path))
+
+
+async def plan_segments_cached(video_path: str, parts: list, media_info: dict, source_key: str) -> bool:
+    # все части плана уже лежат в кеше (например, после потокового рендера того же плана)
+    if not render_cache_enabled(source_key):
+        return False
+    await prepare_color_luts([part_effects(part) for part in parts])
+    return all(
+        is_segment_cached(_segment_command(video_path, part, media_info, source_key)[1])
+        for part in parts
+    )
+
+
+async def _encode_segment(cmd: list, part: dict, output_path: str) -> bool:
+    start_sec = float(part.get('start_sec', 0))
+    end_sec = float(part.get('end_sec', 0))
+    cmd = [*cmd, *THREADS_ARGS, '-y', output_path]
+
+    with span('segment', start=start_sec, end=end_sec, effect=effects_label(part_effects(part))):
+        returncode, stderr = await run_ffmpeg(cmd)
+
+    if returncode != 0:
+        print(f"ошибка FFmpeg при рендере части {start_sec}-{end_sec}: {stderr.decode()[-1000:]}")
+        return False
+
+    return os.path.exists(output_path) and os.path.getsize(output_path) > 0
+
+
+async def render_plan(video_path: str, parts: list, media_info: dict, original_name: str, preview: bool = False):
+    try:
+        if not parts:
+            return "ошибка: нету частей для рендера"
+
+        for i, part in enumerate(parts, 1):
+            if float(part.get('end_sec', 0)) <= float(part.get('start_sec', 0)):
+                return f"ошибка, некорректная длительность части {i}"
+
+        video_dir = os.path.dirname(video_path)
+        if preview:
+            output_video = os.path.join(video_dir, f"{original_name}_preview.mp4")
+            media_info = preview_media_info(media_info)
+            source_filters = [f"scale={media_info['width']}:{media_info['height']}", f'fps={PREVIEW_FPS}']
+            video_args, audio_args = PREVIEW_VIDEO_ARGS, PREVIEW_AUDIO_ARGS
+        else:
+            output_video = os.path.join(video_dir, f"{original_name}_final.mp4")
+            source_filters = None
+            video_args, audio_args = ['-c:v', 'libx264'], ['-c:a', 'aac']
+
+        await prepare_color_luts([part_effects(part) for part in parts])
+        filter_graph, maps = build_filter_graph(parts, media_info, source_filters)
+
+        cmd = [
+            'ffmpeg',
+            '-i', video_path,
+            '-filter_complex', filter_graph,
+            *maps,
+            *video_args,
+        ]
+        if media_info.get('has_audio'):
+            cmd += audio_args
+        cmd += [*THREADS_ARGS, '-y', output_video]
+
+        with span('render', parts=len(parts), preview=preview):
+            returncode, stderr = await run_ffmpeg(cmd)
+
+        if returncode != 0:
+            print(f"ошибка FFmpeg при рендере плана: {stderr.decode()[-1000:]}")
+            if os.path.exists(output_video):
+                os.remove(output_video)
+            return "ошибка при рендере видео"
+
+        if not os.path.exists(output_video) or os.path.getsize(output_video) == 0:
+            return "ошибка: итоговый файл не был создан"
+
+        return output_video
+
+    except Exception as e:
+        return f"ошибка при рендере: {str(e)}"
+
+
+async def render_preview_source(video_path: str, original_name: str) -> str:
+    """
+    Уменьшенная копия исходника для превью планов, которые не собираются одним проходом.
+
+    Нарезка, эффекты-вставки и склейка дальше идут по ней, как по обычному исходнику,
+    поэтому превью старым путём стоит столько же, сколько однопроходное.
+    """
+    output_video = os.path.join(os.path.dirname(video_path), f"{original_name}_preview_source.mp4")
+    cmd = [
+        'ffmpeg',
+        '-i', video_path,
+        '-vf', f"scale=-2:'min(ih,{PREVIEW_HEIGHT})',fps={PREVIEW_FPS}",
+        *PREVIEW_VIDEO_ARGS,
+        *PREVIEW_AUDIO_ARGS,
+        *THREADS_ARGS,
+        '-y', output_video
+    ]
+
+    with span('preview_source'):
+        returncode, stderr = await run_ffmpeg(cmd)
+
+    if returncode != 0 or not os.path.exists(output_video) or os.path.getsize(output_video) == 0:
+        print(f"ошибка FFmpeg при уменьшении исходника для превью: {stderr.decode()[-1000:]}")
+        if os.path.exists(output_video):
+            os.remove(output_video)
+        return "ошибка при подготовке превью"
+
+    return output_video
+
+
+async def render_plan_segments(video_path: str, parts: list, media_info: dict, original_name: str, source_key: str):
+    # план по частям через кеш: части, которые уже рендерились для этого исходника, берутся готовыми
+    for i, part in enumerate(parts, 1):
+        if float(part.get('end_sec', 0)) <= float(part.get('start_sec', 0)):
+            return f"ошибка, некорректная длительность части {i}"
+
+    video_dir = os.path.dirname(video_path)
+    outputs = [
+        os.path.join(video_dir, f"{original_name}_seg_{i}.mp4")
+        for i in range(1, len(parts) + 1)
+    ]
+
+    try:
+        results = await asyncio.gather(*[
+            render_segment(video_path, part, media_info, output_path, source_key)
+            for part, output_path in zip(parts, outputs)
+        ])
+
+        for i, ok in enumerate(results, 1):
+            if not ok:
+                return f"ошибка при рендере части {i}"
+
+        # части закодированы с одинаковыми параметрами, видео склеивается без перекодирования
+        return await merge_video_parts(outputs, original_name, copy=True)
+
+    except Exception as e:
+        return f"ошибка при рендере: {str(e)}"
+
+    finally:
+        for output_path in outputs:
+            if os.path.exists(output_path):
+                os.remove(output_path)
@@ -0,0 +1,111 @@
+"""
+Кеш отрендеренных частей и уже отправленных результатов.
+
+Части лежат файлами в cache/render/ под ключом из исходника, отрезка, фильтров и
+настроек кодирования; при превышении RENDER_CACHE_MAX_BYTES удаляются файлы,
+к которым дольше всего не обращались. Для готовых видео запоминается file_id
+в Telegram, чтобы повторную задачу отправить без рендера и загрузки.
+"""
+import asyncio
+import hashlib
+import json
+import os
+
+from service.cache import DiskCache, SingleFlight, evict_files, link_or_copy
+from service.config import CACHE_DIR, DELIVERED_CACHE_TTL_SEC, RENDER_CACHE_MAX_BYTES
+from service.metrics import inc
+
+
+RENDER_CACHE_DIR = os.path.join(CACHE_DIR, 'render')
+
+_delivered = DiskCache(os.path.join(CACHE_DIR, 'delivered.sqlite3'), ttl=DELIVERED_CACHE_TTL_SEC)
+_inflight = SingleFlight()
+
+
+def render_cache_enabled(source_key: str) -> bool:
+    return bool(source_key) and RENDER_CACHE_MAX_BYTES > 0
+
+
+def segment_key(source_key: str, start_sec: float, end_sec: float, video_filters: list, audio_filters: list, encoder_args: list) -> str:
+    raw = json.dumps([source_key, round(start_sec, 3), round(end_sec, 3), video_filters, audio_filters, encoder_args])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def is_segment_cached(key: str) -> bool:
+    return os.path.exists(os.path.join(RENDER_CACHE_DIR, f'{key}.mp4'))
+
+
+def _restore(cache_path: str, output_path: str) -> bool:
+    if not os.path.exists(cache_path):
+        return False
+
+    # время изменения файла служит отметкой последнего обращения для вытеснения
+    os.utime(cache_path)
+    link_or_copy(cache_path, output_path)
+    return True
+
+
+def _evict(keep: str):
+    inc('render_cache_evictions_total', evict_files(RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES, keep))
+
+
+async def cached_segment(key: str, output_path: str, render) -> bool:
+    """
+    Отдаёт часть из кеша или рендерит её один раз и кладёт в кеш.
+
+    Args:
+        key: Ключ части из segment_key()
+        output_path: Куда положить готовую часть
+        render: async функция (путь) -> bool, которая рендерит часть по указанному пути
+
+    Returns:
+        True, если часть лежит в output_path
+    """
+    cache_path = os.path.join(RENDER_CACHE_DIR, f'{key}.mp4')
+
+    if key not in _inflight and await asyncio.to_thread(_restore, cache_path, output_path):
+        inc('render_cache_total', result='hit')
+        return True
+
+    inc('render_cache_total', result='shared' if key in _inflight else 'miss')
+
+    async def render_to_cache():
+        os.makedirs(RENDER_CACHE_DIR, exist_ok=True)
+        tmp_path = os.path.join(RENDER_CACHE_DIR, f'{key}_{os.getpid()}.tmp.mp4')
+        try:
+            ok = await render(tmp_path)
+            if ok:
+                os.replace(tmp_path, cache_path)
+                await asyncio.to_thread(_evict, cache_path)
+            return ok
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # одинаковые части из одновременных задач рендерятся один раз
+    if not await _inflight.do(key, render_to_cache):
+        return False
+    return await asyncio.to_thread(_restore, cache_path, output_path)
+
+
+def delivered_key(source_key: str, plan: dict) -> str:
+    response = plan.get('response', '') if isinstance(plan, dict) else str(plan)
+    try:
+        # одинаковый план с другими пробелами или порядком полей - та же задача
+        response = json.dumps(json.loads(response), sort_keys=True, ensure_ascii=False)
+    except (TypeError, json.JSONDecodeError):
+        pass
+    return hashlib.sha256(f'{source_key}|{response}'.encode()).hexdigest()
+
+
+async def get_delivered_file_id(source_key: str, plan: dict):
+    if not source_key or not plan:
+        return None
+    file_id = await _delivered.get(delivered_key(source_key, plan))
+    inc('delivered_cache_total', result='hit' if file_id else 'miss')
+    return file_id
+
+
+async def remember_delivered(source_key: str, plan: dict, file_id: str):
+    if source_key and plan and file_id:
+        await _delivered.set(delivered_key(source_key, plan), file_id)
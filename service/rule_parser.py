@@ -0,0 +1,253 @@
+import json
+import re
+
+from service.effects import EFFECTS, INTENSITY_LIMITS
+from service.metrics import inc
+from service.ollama import assembly_request
+from service.plan_cache import normalize_prompt
+from service.probe import probe_media
+from service.prompts import EFFECT_NAMES, VIDEO_EDITING_PROMPT
+
+
+NUMBER = r'(\d+(?:[.,]\d+)?)'
+SECONDS = r'(?:секунд\w*|сек|seconds?|secs?|s)'
+
+# (регулярка, функция (числа, длительность) -> (начало, конец)); порядок важен
+TIME_PATTERNS = [
+    (rf'\b(?:с|со|from) {NUMBER}(?: {SECONDS})? (?:по|до|to) {NUMBER}(?: {SECONDS})?', lambda n, d: (n[0], n[1])),
+    (rf'\b(?:первые|first) {NUMBER} {SECONDS}', lambda n, d: (0, n[0])),
+    (rf'\b(?:последние|last) {NUMBER} {SECONDS}', lambda n, d: (d - n[0], d)),
+    (rf'\b(?:на|at) {NUMBER}(?: |-)(?:секунде|second)', lambda n, d: (n[0] - 0.5, n[0] + 0.5)),
+    (rf'\b(?:с|со|from|after) {NUMBER} {SECONDS}', lambda n, d: (n[0], d)),
+]
+
+# слова, которые не меняют смысл запроса; всё остальное неизвестное отправляет запрос в LLM
+FILLER_WORDS = {
+    'сделай', 'сделать', 'сделайте', 'добавь', 'добавить', 'добавил', 'добавьте', 'примени', 'применить',
+    'наложи', 'наложить', 'нужно', 'надо', 'чтобы', 'ты', 'мне', 'пожалуйста', 'плиз', 'хочу', 'можешь',
+    'можно', 'видео', 'видос', 'ролик', 'эффект', 'эффектом', 'эффекта', 'на', 'в', 'во', 'с', 'со', 'по',
+    'до', 'и', 'а', 'также', 'еще', 'затем', 'потом', 'это', 'этот', 'всё', 'все', 'весь', 'всего',
+    'целиком', 'фрагмент', 'отрезок', 'часть', 'кусок', 'момент',
+    'please', 'make', 'add', 'apply', 'the', 'a', 'an', 'video', 'effect', 'and', 'then', 'in', 'on', 'to',
+    'of', 'whole', 'entire', 'clip',
+}
+
+# слова уменьшения: у большинства эффектов сила только усиливает (контраст 1 + p), поэтому
+# "уменьшить контраст" разбирать правилами нельзя; эффекты, которые сами означают уменьшение, - исключение
+DECREASE_STEMS = ('уменьш', 'сниж', 'сниз', 'пониз', 'пониж', 'меньш', 'ослаб', 'убав', 'reduc', 'decreas', 'lower', 'less')
+DECREASE_EFFECTS = {'desaturate', 'zoom_out'}
+
+
+def _stem(word: str) -> str:
+    # грубый стемминг: отрезаем окончание, чтобы "затемнить" совпадало с "затемни" и "затемнение"
+    return word[:max(3, len(word) - 3)]
+
+
+def _load_synonyms() -> list[tuple[list[str], str]]:
+    synonyms = {}
+
+    for name, description, line in re.findall(
+        r'\*\*(\w+)\*\* - ([^\n]+)\n\s+Синонимы: ([^\n]+)', VIDEO_EDITING_PROMPT
+    ):
+        for phrase in [description] + line.split(','):
+            synonyms.setdefault(phrase, name)
+
+    for phrases, name in re.findall(r'^\s*- ((?:"[^"]+"(?: = )?)+) → (\w+)$', VIDEO_EDITING_PROMPT, re.MULTILINE):
+        for phrase in re.findall(r'"([^"]+)"', phrases):
+            synonyms.setdefault(phrase, name)
+
+    result = []
+    for phrase, name in synonyms.items():
+        if name not in EFFECT_NAMES or 'X' in phrase:
+            continue
+        words = normalize_prompt(phrase).split()
+        # описания вида "затемнение видео" без служебных слов
+        words = [w for w in words if w not in ('видео', 'эффект')]
+        if words:
+            result.append(([_stem(w) for w in words], name))
+
+    # сначала длинные фразы: "затемнение по краям" (виньетка) раньше "затемнение"
+    result.sort(key=lambda item: (-len(item[0]), -sum(len(s) for s in item[0])))
+    return result
+
+
+EFFECT_SYNONYMS = _load_synonyms()
+
+
+def _to_float(value: str) -> float:
+    return float(value.replace(',', '.'))
+
+
+def _extract_times(text: str, duration: float):
+    ranges = []
+
+    for pattern, to_range in TIME_PATTERNS:
+        def replace(match):
+            numbers = [_to_float(g) for g in match.groups()]
+            ranges.append(to_range(numbers, duration))
+            return f' __t{len(ranges) - 1}__ '
+
+        text = re.sub(pattern, replace, text)
+
+    return text, ranges
+
+
+def _tokenize(text: str, ranges: list):
+    # превращаем текст в последовательность ('time', отрезок) и ('effect', {"name", "intensity"})
+    words = text.split()
+    items = []
+    pending_intensity = None
+    i = 0
+
+    while i < len(words):
+        word = words[i]
+
+        time_match = re.fullmatch(r'__t(\d+)__', word)
+        if time_match:
+            items.append(('time', ranges[int(time_match.group(1))]))
+            i += 1
+            continue
+
+        percent_match = re.fullmatch(r'(\d+(?:[.,]\d+)?)%', word)
+        if percent_match:
+            # "затемни на 30%" - к предыдущему эффекту, "на 30% затемни" - к следующему
+            intensity = _to_float(percent_match.group(1)) / 100
+            if items and items[-1][0] == 'effect' and items[-1][1]['intensity'] is None:
+                items[-1][1]['intensity'] = intensity
+            elif pending_intensity is None:
+                pending_intensity = intensity
+            else:
+                return None
+            i += 1
+            continue
+
+        for stems, name in EFFECT_SYNONYMS:
+            window = words[i:i + len(stems)]
+            if len(window) == len(stems) and all(w.startswith(s) for w, s in zip(window, stems)):
+                if name not in DECREASE_EFFECTS and any(w.startswith(DECREASE_STEMS) for w in window):
+                    return None
+                items.append(('effect', {"name": name, "intensity": pending_intensity}))
+                pending_intensity = None
+                i += len(stems)
+                break
+        else:
+            if word in FILLER_WORDS:
+                i += 1
+                continue
+            return None
+
+    if pending_intensity is not None:
+        return None
+
+    for kind, value in items:
+        # проценты понятны только для эффектов с силой от 0 до 1, скорость и поворот оставляем LLM
+        if kind == 'effect' and value['intensity'] is not None:
+            if EFFECTS[value['name']]['default'] is None or value['name'] in INTENSITY_LIMITS:
+                return None
+
+    return items
+
+
+def _pair_effects(items: list, duration: float):
+    # соседние эффекты объединяются в группу: "чёрно-белое и замедлить с 5 по 10" - два эффекта на отрезке
+    groups = []
+    for kind, value in items:
+        if kind == 'effect' and groups and groups[-1][0] == 'effect':
+            groups[-1][1].append(value)
+        else:
+            groups.append((kind, [value] if kind == 'effect' else value))
+
+    times = [value for kind, value in groups if kind == 'time']
+    effects = [value for kind, value in groups if kind == 'effect']
+
+    if not effects:
+        return None
+
+    if not times:
+        # эффекты без отрезка - на всё видео
+        return [((0, duration), effects[0])] if len(effects) == 1 else None
+
+    if len(times) != len(effects):
+        return None
+
+    # отрезки и группы эффектов должны чередоваться: "с 5 по 10 размыть, с 20 по 25 замедлить" или наоборот
+    kinds = [kind for kind, _ in groups]
+    expected = [kinds[0], 'effect' if kinds[0] == 'time' else 'time'] * len(times)
+    if kinds != expected:
+        return None
+
+    return [
+        (groups[i][1], groups[i + 1][1]) if kinds[0] == 'time' else (groups[i + 1][1], groups[i][1])
+        for i in range(0, len(groups), 2)
+    ]
+
+
+def _build_parts(segments: list, duration: float):
+    edits = []
+    for (start_sec, end_sec), effects in segments:
+        start_sec = max(0.0, min(float(start_sec), duration))
+        end_sec = max(0.0, min(float(end_sec), duration))
+        if end_sec - start_sec <= 0:
+            return None
+        edits.append((start_sec, end_sec, effects))
+
+    edits.sort(key=lambda edit: edit[:2])
+    for (_, prev_end, _), (start_sec, _, _) in zip(edits, edits[1:]):
+        if start_sec < prev_end:
+            return None
+
+    parts = []
+    position = 0.0
+    for start_sec, end_sec, effects in edits:
+        if start_sec > position:
+            parts.append({"start_sec": position, "end_sec": start_sec, "action": "keep", "effects": []})
+        parts.append({"start_sec": start_sec, "end_sec": end_sec, "action": "edit", "effects": effects})
+        position = end_sec
+    if position < duration:
+        parts.append({"start_sec": position, "end_sec": duration, "action": "keep", "effects": []})
+
+    return {"parts": parts}
+
+
+def parse_prompt(user_prompt: str, duration: float):
+    """
+    Разбирает типовой запрос без LLM.
+
+    Args:
+        user_prompt: Запрос пользователя о монтаже видео
+        duration: Длительность видео в секундах
+
+    Returns:
+        План {"parts": [...]} или None, если запрос не удалось разобрать полностью
+    """
+    if not duration or duration <= 0:
+        return None
+    duration = float(duration)
+
+    text, ranges = _extract_times(normalize_prompt(user_prompt), duration)
+
+    items = _tokenize(text, ranges)
+    if items is None:
+        return None
+
+    segments = _pair_effects(items, duration)
+    if segments is None:
+        return None
+
+    return _build_parts(segments, duration)
+
+
+async def plan_request(user_prompt: str, video_path: str, file_key: str = None):
+    try:
+        media_info = await probe_media(video_path, file_key)
+        plan = parse_prompt(user_prompt, media_info['duration'])
+    except Exception as e:
+        print(f"ошибка локального разбора запроса: {e}")
+        plan = None
+
+    if plan is not None:
+        inc('rule_parser_total', result='hit')
+        return {"response": json.dumps(plan, ensure_ascii=False)}
+
+    inc('rule_parser_total', result='miss')
+    return await assembly_request(user_prompt)
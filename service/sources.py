@@ -0,0 +1,126 @@
+import asyncio
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+from service.cache import SingleFlight
+from service.config import CACHE_DIR, SOURCE_CACHE_MAX_BYTES, SOURCE_PIN_SEC, SOURCES_DIR
+from service.jobs import active_video_paths
+from service.metrics import inc
+
+
+# Скачанные исходники хранятся по file_unique_id и переиспользуются для новых запросов,
+# индекс с размерами и временем обращения нужен для вытеснения по квоте
+SOURCES_DB = os.path.join(CACHE_DIR, 'sources.sqlite3')
+
+_downloads = SingleFlight()
+# путь -> до какого времени исходник не вытесняется: задачи для него ещё нет в очереди
+_pinned = {}
+
+
+def source_path(file_key: str) -> str:
+    return os.path.join(SOURCES_DIR, f'video_{file_key}.mp4')
+
+
+def _connect():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(SOURCES_DB, timeout=30, isolation_level=None)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sources (
+            file_key TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            accessed_at REAL NOT NULL
+        )
+    ''')
+    return conn
+
+
+def _remember(file_key: str, path: str, busy: set):
+    with closing(_connect()) as conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO sources (file_key, path, size, accessed_at) VALUES (?, ?, ?, ?)',
+            (file_key, path, os.path.getsize(path), time.time())
+        )
+        _evict(conn, busy | {path})
+
+
+def _evict(conn, busy: set):
+    total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM sources').fetchone()[0]
+    if total <= SOURCE_CACHE_MAX_BYTES:
+        return
+
+    # исходники задач, которые ещё в очереди или в работе, не удаляем
+    for file_key, path, size in conn.execute('SELECT file_key, path, size FROM sources ORDER BY accessed_at').fetchall():
+        if total <= SOURCE_CACHE_MAX_BYTES:
+            break
+        if path in busy:
+            continue
+        if os.path.exists(path):
+            os.remove(path)
+        conn.execute('DELETE FROM sources WHERE file_key = ?', (file_key,))
+        total -= size
+        inc('source_cache_evictions_total')
+
+
+def _pin(path: str):
+    now = time.time()
+    for pinned_path, until in list(_pinned.items()):
+        if until < now:
+            del _pinned[pinned_path]
+    _pinned[path] = now + SOURCE_PIN_SEC
+
+
+async def get_source(file_key: str):
+    """
+    Путь к уже скачанному исходнику или None, если его нужно скачать.
+    """
+    path = source_path(file_key)
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        inc('source_cache_total', result='miss')
+        return None
+
+    inc('source_cache_total', result='hit')
+    _pin(path)
+    await remember_source(file_key, path)
+    return path
+
+
+async def download_source(file_key: str, download) -> str:
+    """
+    Скачивает исходник в кеш один раз, даже если одно видео прислали несколько человек одновременно.
+
+    Args:
+        file_key: file_unique_id видео
+        download: async функция (путь) -> None, которая скачивает видео по указанному пути
+
+    Returns:
+        Путь к исходнику
+    """
+    path = source_path(file_key)
+    _pin(path)
+
+    async def fetch():
+        # видео скачивается во временный файл и появляется под своим именем только целиком
+        os.makedirs(SOURCES_DIR, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.part'
+        try:
+            await download(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        await remember_source(file_key, path)
+        return path
+
+    inc('source_downloads_total', result='shared' if file_key in _downloads else 'download')
+    return await _downloads.do(file_key, fetch)
+
+
+async def remember_source(file_key: str, path: str):
+    # запоминает исходник (или обновляет время обращения) и освобождает место по квоте;
+    # исходники задач в очереди и только что присланные видео не вытесняются
+    now = time.time()
+    busy = await active_video_paths() | {p for p, until in _pinned.items() if until >= now}
+    await asyncio.to_thread(_remember, file_key, path, busy)
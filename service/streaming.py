@@ -0,0 +1,201 @@
+import asyncio
+import json
+import os
+
+from service.config import OLLAMA_MODEL
+from service.effects import is_filter_effect, part_effects
+from service.ffmpeg import merge_video_parts
+from service.metrics import inc
+from service.ollama import stream_ollama
+from service.plan_cache import get_cached_plan, store_plan
+from service.probe import probe_media
+from service.prompts import PLAN_SCHEMA, get_system_prompt
+from service.render import render_segment
+from service.rule_parser import parse_prompt
+
+
+class PartsStreamParser:
+    """
+    Инкрементальный разбор ответа вида {"parts": [{...}, {...}]}.
+
+    feed() принимает очередной кусок текста и возвращает части,
+    объекты которых закрылись в этом куске.
+    """
+
+    def __init__(self):
+        self._buffer = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+        self._key = None
+        # открытые контейнеры: (скобка, ключ, под которым контейнер лежит в родителе)
+        self._stack = []
+        self._part_start = None
+        self._position = 0
+
+    def _in_parts(self) -> bool:
+        # корневой объект -> массив под ключом "parts" -> объект части
+        return (
+            len(self._stack) == 3
+            and self._stack[1] == ('[', 'parts')
+            and self._stack[2][0] == '{'
+        )
+
+    def feed(self, chunk: str) -> list:
+        parts = []
+
+        for char in chunk:
+            self._buffer.append(char)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    self._last_string = ''.join(self._buffer[self._string_start:self._position + 1])
+            elif char == '"':
+                self._in_string = True
+                self._string_start = self._position
+            elif char == ':':
+                self._key = json.loads(self._last_string) if self._last_string else None
+            elif char == ',':
+                self._key = None
+            elif char in '{[':
+                self._stack.append((char, self._key))
+                self._key = None
+                if self._in_parts():
+                    self._part_start = self._position
+            elif char in '}]':
+                if self._in_parts() and char == '}' and self._part_start is not None:
+                    text = ''.join(self._buffer[self._part_start:self._position + 1])
+                    parts.append(json.loads(text))
+                    self._part_start = None
+                if self._stack:
+                    self._stack.pop()
+                self._key = None
+
+            self._position += 1
+
+        return parts
+
+
+class _SegmentScheduler:
+    # приводит поток частей к непрерывной шкале времени и сразу отдаёт их на рендер
+    def __init__(self, video_path: str, media_info: dict, file_key: str = None):
+        self.video_path = video_path
+        self.media_info = media_info
+        self.file_key = file_key
+        self.duration = media_info['duration']
+        self.position = 0.0
+        self.parts = []
+        self.tasks = []
+        self.outputs = []
+        # в плане есть эффект-вставка из effects/: такие планы собираются нарезкой и склейкой (service/parser.py)
+        self.has_inserts = False
+
+        video_dir = os.path.dirname(video_path)
+        name_without_ext = os.path.splitext(os.path.basename(video_path))[0]
+        self.name_without_ext = name_without_ext
+        self._segment_prefix = os.path.join(video_dir, f"{name_without_ext}_seg")
+
+    def add(self, part: dict):
+        start_sec = max(float(part.get('start_sec', 0)), self.position)
+        end_sec = min(float(part.get('end_sec', self.duration)), self.duration)
+
+        if end_sec <= start_sec:
+            return
+
+        effects = part_effects(part)
+        if self.has_inserts or not all(is_filter_effect(effect['name']) for effect in effects):
+            # дальше части не рендерим: план целиком уйдёт в обычный рендер
+            self.has_inserts = True
+            return
+
+        if start_sec > self.position:
+            # пропуск между частями остаётся без изменений
+            self._schedule({"start_sec": self.position, "end_sec": start_sec, "action": "keep", "effects": []})
+
+        self._schedule({**part, "start_sec": start_sec, "end_sec": end_sec})
+
+    def finish(self):
+        if self.position < self.duration:
+            self._schedule({"start_sec": self.position, "end_sec": self.duration, "action": "keep", "effects": []})
+
+    def _schedule(self, part: dict):
+        output_path = f"{self._segment_prefix}_{len(self.parts) + 1}.mp4"
+        self.parts.append(part)
+        self.position = part['end_sec']
+        self.outputs.append(output_path)
+        self.tasks.append(asyncio.create_task(
+            render_segment(self.video_path, part, self.media_info, output_path, self.file_key)
+        ))
+
+    async def cleanup(self):
+        for task in self.tasks:
+            task.cancel()
+        # ждём остановки ffmpeg (run_ffmpeg убивает его при отмене), иначе он допишет удалённые файлы
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for output_path in self.outputs:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+
+
+async def stream_plan_and_render(user_prompt: str, video_path: str, file_key: str = None):
+    """
+    Генерирует план потоком и рендерит части, не дожидаясь конца ответа LLM.
+
+    Returns:
+        (план в формате {"response": ...}, список файлов) или None,
+        если план есть в кеше или разбирается локально и поток не нужен;
+        (план, None) - в плане есть эффекты-вставки, его нужно рендерить обычным путём
+    """
+    media_info = await probe_media(video_path, file_key)
+
+    if parse_prompt(user_prompt, media_info['duration']) is not None:
+        return None
+    if await get_cached_plan(user_prompt, OLLAMA_MODEL) is not None:
+        return None
+
+    parser = PartsStreamParser()
+    scheduler = _SegmentScheduler(video_path, media_info, file_key)
+    response_chunks = []
+
+    try:
+        async for chunk in stream_ollama(get_system_prompt(user_prompt), OLLAMA_MODEL, PLAN_SCHEMA):
+            response_chunks.append(chunk)
+            for part in parser.feed(chunk):
+                inc('streamed_parts_total')
+                scheduler.add(part)
+
+        if scheduler.has_inserts:
+            await scheduler.cleanup()
+            plan = {"response": ''.join(response_chunks)}
+            await store_plan(user_prompt, OLLAMA_MODEL, plan)
+            return plan, None
+
+        if not scheduler.parts:
+            await scheduler.cleanup()
+            return {"response": ''.join(response_chunks)}, ["ошибка: AI не предоставил план монтажа"]
+
+        scheduler.finish()
+        results = await asyncio.gather(*scheduler.tasks)
+    except BaseException:
+        await scheduler.cleanup()
+        raise
+
+    for i, ok in enumerate(results, 1):
+        if not ok:
+            await scheduler.cleanup()
+            return {"response": ''.join(response_chunks)}, [f"ошибка при рендере части {i}"]
+
+    plan = {"response": ''.join(response_chunks)}
+    await store_plan(user_prompt, OLLAMA_MODEL, plan)
+
+    # все части закодированы с одинаковыми параметрами, склейка без перекодирования
+    final_video = await merge_video_parts(scheduler.outputs, scheduler.name_without_ext, copy=True)
+    await scheduler.cleanup()
+
+    return plan, [final_video]
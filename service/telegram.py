@@ -0,0 +1,93 @@
+import asyncio
+import os
+import uuid
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+from aiogram import Bot, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import SimpleFilesPathWrapper, TelegramAPIServer
+from aiogram.enums import ParseMode
+
+from service.cache import link_or_copy
+from service.config import BOT_API_LOCAL_FILES_DIR, BOT_API_SERVER_FILES_DIR, BOT_API_URL
+
+
+def create_bot() -> Bot:
+    """
+    Создаёт бота для облачного Bot API или для своего сервера telegram-bot-api (BOT_API_URL).
+
+    Свой сервер запускается с --local: файлы не ограничены 20 МБ и лежат у него на диске,
+    поэтому скачивание и загрузка идут по путям к файлам, а не через HTTP.
+    """
+    if not BOT_API_URL:
+        return Bot(token=os.getenv('TOKEN'), parse_mode=ParseMode.HTML)
+
+    options = {}
+    if BOT_API_SERVER_FILES_DIR and BOT_API_LOCAL_FILES_DIR:
+        # сервер в контейнере видит общую папку по другому пути, чем бот
+        options['wrap_local_file'] = SimpleFilesPathWrapper(
+            Path(BOT_API_SERVER_FILES_DIR),
+            Path(BOT_API_LOCAL_FILES_DIR)
+        )
+
+    api = TelegramAPIServer.from_base(BOT_API_URL, is_local=True, **options)
+    return Bot(token=os.getenv('TOKEN'), session=AiohttpSession(api=api), parse_mode=ParseMode.HTML)
+
+
+async def fetch_video(bot: Bot, file_id: str, destination: str):
+    file_info = await bot.get_file(file_id)
+
+    if bot.session.api.is_local:
+        # локальный сервер отдаёт путь к уже скачанному им файлу
+        local_path = str(bot.session.api.wrap_local_file.to_local(file_info.file_path))
+        await asyncio.to_thread(link_or_copy, local_path, destination)
+        return
+
+    await bot.download_file(file_info.file_path, destination)
+
+
+def upload_file(bot: Bot, file_path: str):
+    if bot.session.api.is_local:
+        try:
+            # локальный сервер сам читает файл по пути, видео не передаётся через HTTP
+            server_path = bot.session.api.wrap_local_file.to_server(os.path.abspath(file_path))
+            return f'file://{server_path}'
+        except ValueError:
+            # файл вне общей с сервером папки (рабочая папка задачи в памяти) - сервер его не увидит
+            pass
+
+    # FSInputFile читает файл с диска кусками во время отправки, в памяти он целиком не лежит
+    return types.FSInputFile(file_path, filename=os.path.basename(file_path))
+
+
+def _server_sees(bot: Bot, file_path: str) -> bool:
+    try:
+        bot.session.api.wrap_local_file.to_server(os.path.abspath(file_path))
+        return True
+    except ValueError:
+        return False
+
+
+@asynccontextmanager
+async def video_upload(bot: Bot, file_path: str):
+    """
+    Файл для send_video; с локальным сервером - всегда по пути.
+
+    Результаты задач лежат в рабочей папке (часто в /dev/shm), которую сервер не видит.
+    Такой файл на время отправки кладётся ссылкой или копией в общую папку
+    BOT_API_LOCAL_FILES_DIR/uploads и удаляется после отправки.
+    """
+    shared_path = None
+    if bot.session.api.is_local and BOT_API_LOCAL_FILES_DIR and not _server_sees(bot, file_path):
+        upload_dir = os.path.join(BOT_API_LOCAL_FILES_DIR, 'uploads')
+        os.makedirs(upload_dir, exist_ok=True)
+        shared_path = os.path.join(upload_dir, f'{uuid.uuid4().hex}_{os.path.basename(file_path)}')
+        await asyncio.to_thread(link_or_copy, file_path, shared_path)
+
+    try:
+        yield upload_file(bot, shared_path or file_path)
+    finally:
+        # локальный сервер читает файл во время запроса, после ответа он больше не нужен
+        if shared_path and os.path.exists(shared_path):
+            os.remove(shared_path)
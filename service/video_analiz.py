@@ -1,29 +1,18 @@
 import asyncio
+import hashlib
 import os
 import time
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 
-class VideoStyleAnalyzer:
-    def __init__(self, api_key: str):
-        genai.configure(api_key=api_key)
-        self.model_name = "gemini-3-pro-latest"
+from service.cache import DiskCache, SingleFlight
+from service.config import CACHE_DIR, GEMINI_CONCURRENCY, STYLE_CACHE_TTL_SEC
+from service.metrics import inc, span
+from service.probe import file_sha256, probe_media
+from service.proxy import ANALYSIS_PROXY, analysis_proxy
 
-    async def analyze_video_style(self, video_path: str) -> str:
-        print(f"загрузка видео примера для анализа: {video_path}")
-        
-        video_file = genai.upload_file(path=video_path)
-        print(f"ждём обработки (URI: {video_file.uri})...")
-        
-        while video_file.state.name == "PROCESSING":
-            await asyncio.sleep(5)
-            video_file = genai.get_file(video_file.name)
-            print(".", end="", flush=True)
-        
-        if video_file.state.name == "FAILED":
-            raise RuntimeError("ошибка обработки видео.")
-        
-        prompt = """
+
+STYLE_PROMPT = """
         Ты эксперт по монтажу видео: режиссёр, колорист и дизайнер. Сделай полный реверс-инжиниринг стиля монтажа этого видео. 
         Опиши каждую мелочь, чтобы монтажёр мог воспроизвести стиль 1:1. Избегай обобщений – только конкретные параметры, измерения, цвета (в HEX или именах), шрифты, тайминги.
         
@@ -59,27 +48,122 @@ class VideoStyleAnalyzer:
 
         6. **Мелочи и паттерны:**
            - Любые повторяющиеся элементы: логотипы, водяные знаки, aspect ratio (16:9, 9:16).
-           - Качество: разрешение, FPS видео, артефакты.
+           - Качество: разрешение и FPS исходника (из параметров ниже), артефакты.
            - Рекомендации по recreation: инструменты (Premiere, After Effects), плагины.
 
         Будь исчерпывающе детальным – опиши по таймкодам (например, 00:15-00:30: эффект X).
         """
-        
-        model = genai.GenerativeModel(model_name=self.model_name)
-        loop = asyncio.get_running_loop()
-        response = await loop.run_in_executor(
-            None, 
-            lambda: model.generate_content(
-                [video_file, prompt],
-                request_options={"timeout": 600}
-            )
+
+# Gemini получает уменьшенную копию, поэтому параметры исходника передаются текстом
+SOURCE_PROMPT = """
+        Тебе передана уменьшенная копия видео для анализа. Параметры исходника:
+        разрешение {width}x{height}, частота кадров {fps} к/с, длительность {duration} с.
+        Размеры, отступы и тайминги указывай относительно исходника.
+        """
+
+# Версия промпта для ключей кеша отчётов: меняется автоматически при любой правке промпта или прокси
+STYLE_PROMPT_VERSION = hashlib.sha1(
+    f"{STYLE_PROMPT}|{SOURCE_PROMPT}|{sorted(ANALYSIS_PROXY.items())}".encode()
+).hexdigest()[:12]
+
+# Опрос состояния загруженного файла: сначала часто, потом всё реже
+POLL_START_SEC = 0.5
+POLL_MAX_SEC = 10
+POLL_TIMEOUT_SEC = 600
+
+# SDK Gemini синхронный: все вызовы идут в потоках, а число одновременных анализов ограничено
+_semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+_reports = DiskCache(os.path.join(CACHE_DIR, 'styles.sqlite3'), ttl=STYLE_CACHE_TTL_SEC)
+_inflight = SingleFlight()
+
+
+class VideoStyleAnalyzer:
+    def __init__(self, api_key: str):
+        genai.configure(api_key=api_key)
+        self.model_name = "gemini-3-pro-latest"
+
+    async def analyze_video_style(self, video_path: str) -> str:
+        content_hash = await asyncio.to_thread(file_sha256, video_path)
+        key = f"{content_hash}|{self.model_name}|{STYLE_PROMPT_VERSION}"
+
+        report = await _reports.get(key)
+        if report is not None:
+            inc('style_cache_total', result='hit')
+            return report
+
+        inc('style_cache_total', result='shared' if key in _inflight else 'miss')
+
+        async def analyze_and_store():
+            report = await self._analyze(video_path, content_hash)
+            await _reports.set(key, report)
+            return report
+
+        # один и тот же пример, присланный одновременно, анализируется один раз
+        return await _inflight.do(key, analyze_and_store)
+
+    async def _wait_processing(self, video_file):
+        delay = POLL_START_SEC
+        started = time.monotonic()
+
+        while video_file.state.name == "PROCESSING":
+            if time.monotonic() - started > POLL_TIMEOUT_SEC:
+                raise RuntimeError("ошибка: видео слишком долго обрабатывается.")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, POLL_MAX_SEC)
+            video_file = await asyncio.to_thread(genai.get_file, video_file.name)
+            print(".", end="", flush=True)
+
+        return video_file
+
+    @staticmethod
+    def _source_prompt(media_info: dict) -> str:
+        width, height = media_info.get('width'), media_info.get('height')
+        if not width or not height:
+            return ''
+        if abs(media_info.get('rotation') or 0) % 180 == 90:
+            width, height = height, width
+        fps = media_info.get('fps')
+        return SOURCE_PROMPT.format(
+            width=width,
+            height=height,
+            fps=f'{fps:.3g}' if fps else 'неизвестна',
+            duration=f"{media_info.get('duration') or 0:.1f}",
         )
-        
-        try:
-            genai.delete_file(video_file.name)
-        except:
-            pass
-        
+
+    async def _analyze(self, video_path: str, content_hash: str) -> str:
+        # для анализа стиля хватает уменьшенной копии, разрешение и fps исходника идут в промпт
+        media_info = await probe_media(video_path, content_hash)
+        upload_path = await analysis_proxy(video_path, file_key=content_hash)
+        prompt = STYLE_PROMPT + self._source_prompt(media_info)
+
+        async with _semaphore:
+            print(f"загрузка видео примера для анализа: {video_path}")
+
+            with span('gemini_upload'):
+                video_file = await asyncio.to_thread(genai.upload_file, path=upload_path)
+            print(f"ждём обработки (URI: {video_file.uri})...")
+
+            try:
+                with span('gemini_processing'):
+                    video_file = await self._wait_processing(video_file)
+
+                if video_file.state.name == "FAILED":
+                    raise RuntimeError("ошибка обработки видео.")
+
+                model = genai.GenerativeModel(model_name=self.model_name)
+                with span('gemini_generate'):
+                    response = await asyncio.to_thread(
+                        lambda: model.generate_content(
+                            [video_file, prompt],
+                            request_options={"timeout": 600}
+                        )
+                    )
+            finally:
+                try:
+                    await asyncio.to_thread(genai.delete_file, video_file.name)
+                except:
+                    pass
+
         return response.text
 
 # Пример использования
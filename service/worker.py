@@ -0,0 +1,224 @@
+import asyncio
+import os
+import socket
+
+from aiogram import Bot, types
+
+from service.config import JOB_LEASE_SEC, JOB_MAX_ATTEMPTS, STREAM_PLANS, WORKER_POLL_SEC
+from service.jobs import (
+    STAGE_DONE, STAGE_FAILED, STAGE_PLANNED, STAGE_QUEUED, STAGE_RENDERED,
+    active_job_ids, claim_job, release_job, renew_lease, update_job,
+)
+from service.metrics import add_span, inc, job_trace, span
+from service.parser import process_video_with_ffmpeg
+from service.render_cache import get_delivered_file_id, remember_delivered
+from service.rule_parser import plan_request
+from service.streaming import stream_plan_and_render
+from service.telegram import video_upload
+from service.workspace import WorkspaceRamExceeded, create_workspace, find_workspace, sweep_workspaces
+
+
+def make_worker_id(index: int = 0) -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{index}"
+
+
+class LeaseLost(Exception):
+    pass
+
+
+async def _keep_lease(job: dict):
+    # продлеваем аренду, пока задача в работе, иначе её заберёт другой воркер;
+    # возврат из функции значит, что задачу уже забрали и свою копию нужно остановить
+    while True:
+        await asyncio.sleep(JOB_LEASE_SEC / 3)
+        try:
+            if not await renew_lease(job['id'], job['worker']):
+                return
+        except Exception as e:
+            print(f"ошибка при продлении аренды задачи {job['id']}: {e}")
+
+
+async def _save(job: dict, **fields):
+    if not await update_job(job['id'], job['worker'], **fields):
+        raise LeaseLost(f"задачу {job['id']} забрал другой воркер")
+
+
+async def _deliver(bot: Bot, job: dict):
+    for file_path in job['result']:
+        if os.path.exists(file_path):
+            with span('upload', size=os.path.getsize(file_path)):
+                async with video_upload(bot, file_path) as upload:
+                    message = await bot.send_video(
+                        job['chat_id'],
+                        upload,
+                        caption="Превью монтажа" if job['preview'] else f"Часть видео"
+                    )
+            # удаляем только после того, как загрузка завершилась
+            os.remove(file_path)
+
+            if len(job['result']) == 1 and message.video and not job['preview']:
+                await remember_delivered(job['file_key'], job['plan'], message.video.file_id)
+
+    if job['preview']:
+        # полный рендер по кнопке берёт план этой задачи, пробы исходника уже в кеше
+        await bot.send_message(
+            job['chat_id'],
+            'Если монтаж устраивает, запустите рендер в полном качестве',
+            reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[[
+                types.InlineKeyboardButton(text='Рендер в полном качестве', callback_data=f"full:{job['id']}")
+            ]])
+        )
+
+
+async def _finish(bot: Bot, job: dict):
+    if not await release_job(job['id'], STAGE_DONE, job['worker']):
+        raise LeaseLost(f"задачу {job['id']} забрал другой воркер")
+    inc('jobs_total', status=STAGE_DONE)
+    # исходник остаётся в кеше для следующих запросов, место освобождает квота в service/sources.py
+    await bot.send_message(job['chat_id'], 'Обработка завершена!')
+
+
+async def _fail(bot: Bot, job: dict, error: str):
+    if not await release_job(job['id'], STAGE_FAILED, job['worker'], error=error):
+        # задачей уже занимается другой воркер, он и сообщит результат
+        return
+    inc('jobs_total', status=STAGE_FAILED)
+    await bot.send_message(job['chat_id'], error)
+    await bot.send_message(job['chat_id'], 'Обработка завершена!')
+
+
+def _is_rendered(result_files) -> bool:
+    # при ошибке парсер возвращает список с текстом ошибки вместо путей к файлам
+    return bool(result_files) and all(os.path.exists(path) for path in result_files)
+
+
+async def process_job(bot: Bot, job: dict):
+    if job['stage'] == STAGE_RENDERED and not _is_rendered(job['result']):
+        # результат лежал в рабочей папке упавшего воркера и пропал вместе с ней - рендерим заново
+        job['stage'] = STAGE_PLANNED
+
+    # потоковый рендер делает части в полном качестве, превью ему не подходит
+    if job['stage'] == STAGE_QUEUED and STREAM_PLANS and not job['preview']:
+        streamed = await stream_plan_and_render(job['prompt'], job['video_path'], job['file_key'])
+        if streamed is not None and streamed[1] is None:
+            # план с эффектами-вставками: дальше обычный рендер по готовому плану
+            job['plan'] = streamed[0]
+            job['stage'] = STAGE_PLANNED
+            await _save(job, stage=STAGE_PLANNED, plan=job['plan'])
+        elif streamed is not None:
+            job['plan'], result_files = streamed
+            if not _is_rendered(result_files):
+                await _fail(bot, job, f"Ошибка: {result_files[0] if result_files else 'Неизвестная ошибка'}")
+                return
+
+            job['result'] = result_files
+            job['stage'] = STAGE_RENDERED
+            await _save(job, stage=STAGE_RENDERED, plan=job['plan'], result=result_files)
+
+    if job['stage'] == STAGE_QUEUED:
+        job['plan'] = await plan_request(job['prompt'], job['video_path'], job['file_key'])
+        job['stage'] = STAGE_PLANNED
+        await _save(job, stage=STAGE_PLANNED, plan=job['plan'])
+        await bot.send_message(
+            job['chat_id'],
+            'супер, мы получили и проанализировали ваше описание, сейчас работаем над монтажем видео..'
+        )
+
+    if job['stage'] == STAGE_PLANNED:
+        file_id = None if job['preview'] else await get_delivered_file_id(job['file_key'], job['plan'])
+        if file_id:
+            # то же видео с тем же планом уже отправляли: пересылаем готовый файл без рендера и загрузки
+            await bot.send_video(job['chat_id'], file_id, caption=f"Часть видео")
+            await _finish(bot, job)
+            return
+
+        result_files = await process_video_with_ffmpeg(job['video_path'], job['plan'], job['file_key'], job['preview'])
+
+        if not _is_rendered(result_files):
+            await _fail(bot, job, f"Ошибка: {result_files[0] if result_files else 'Неизвестная ошибка'}")
+            return
+
+        job['result'] = result_files
+        job['stage'] = STAGE_RENDERED
+        await _save(job, stage=STAGE_RENDERED, result=result_files)
+
+    if job['stage'] == STAGE_RENDERED:
+        await _deliver(bot, job)
+        await _finish(bot, job)
+
+
+async def _run_job(bot: Bot, job: dict):
+    source_path = job['video_path']
+    workspace = None
+
+    try:
+        if job['stage'] == STAGE_RENDERED and _is_rendered(job['result']):
+            # результат прошлой попытки уже готов, его папку не трогаем
+            workspace = await asyncio.to_thread(find_workspace, job['id'])
+        if workspace is None:
+            # своя папка на задачу: промежуточные файлы одновременных задач с одним исходником не пересекаются;
+            # повторная попытка идёт на диск - в памяти могло не хватить места
+            workspace = await asyncio.to_thread(create_workspace, job['id'], source_path, job['attempts'] <= 1)
+        job['video_path'] = workspace.link_source(source_path)
+
+        with job_trace(f"{job['id']}_{job['attempts']}"):
+            if job['download_sec'] is not None and job['attempts'] <= 1:
+                # исходник скачивал хендлер бота до постановки задачи
+                add_span('telegram_download', job['download_started'], job['download_sec'])
+            try:
+                await workspace.run(process_job(bot, job))
+            except WorkspaceRamExceeded as e:
+                # задача не поместилась в памяти: повторяем её на диске с последнего сохранённого этапа
+                print(f"{e}, повтор на диске")
+                await asyncio.to_thread(workspace.cleanup)
+                workspace = await asyncio.to_thread(create_workspace, job['id'], source_path, False)
+                job['video_path'] = workspace.link_source(source_path)
+                await workspace.run(process_job(bot, job))
+    except LeaseLost as e:
+        print(e)
+    except Exception as e:
+        try:
+            await _fail(bot, job, f"Произошла ошибка: {str(e)}")
+        except Exception as notify_error:
+            print(f"ошибка при завершении задачи {job['id']}: {notify_error}")
+    finally:
+        if workspace is not None:
+            await asyncio.to_thread(workspace.cleanup)
+
+
+async def run_worker(bot: Bot, worker_id: str):
+    print(f"воркер {worker_id} запущен")
+
+    # рабочие папки завершённых задач, оставшиеся после падения процесса
+    removed = await asyncio.to_thread(sweep_workspaces, await active_job_ids())
+    if removed:
+        print(f"удалено рабочих папок завершённых задач: {removed}")
+
+    while True:
+        job = await claim_job(worker_id)
+
+        if job is None:
+            await asyncio.sleep(WORKER_POLL_SEC)
+            continue
+
+        print(f"воркер {worker_id} взял задачу {job['id']} на этапе {job['stage']}")
+
+        if job['attempts'] > JOB_MAX_ATTEMPTS:
+            # задача раз за разом роняет воркер, дальше не пробуем
+            await _fail(bot, job, 'Ошибка: не удалось обработать видео после нескольких попыток')
+            continue
+
+        job_task = asyncio.create_task(_run_job(bot, job))
+        lease_task = asyncio.create_task(_keep_lease(job))
+
+        try:
+            await asyncio.wait({job_task, lease_task}, return_when=asyncio.FIRST_COMPLETED)
+            if not job_task.done():
+                # аренду забрал другой воркер: он доделает задачу, свою копию останавливаем
+                print(f"воркер {worker_id} потерял аренду задачи {job['id']}, останавливаем")
+                job_task.cancel()
+        finally:
+            lease_task.cancel()
+            if not job_task.done():
+                job_task.cancel()
+            await asyncio.gather(job_task, lease_task, return_exceptions=True)
@@ -0,0 +1,200 @@
+"""
+Рабочие папки задач рендера.
+
+Каждая задача получает свою папку, а исходник попадает в неё ссылкой. Все промежуточные
+файлы (_part_N, эффекты, списки склейки, _final) пишутся рядом с исходником, то есть в папку
+задачи, и одновременные задачи с одним исходником не пересекаются. Папка по возможности
+создаётся в tmpfs (/dev/shm), чтобы промежуточные файлы не касались диска. Если задача
+по оценке слишком большая или общий лимит памяти занят, папка создаётся на диске.
+После завершения, ошибки или отмены папка удаляется целиком.
+"""
+import asyncio
+import os
+import shutil
+import threading
+
+from service.cache import link_or_copy
+from service.config import (
+    CACHE_DIR, WORKSPACE_JOB_MAX_BYTES, WORKSPACE_RAM_DIR, WORKSPACE_RAM_JOB_MAX_BYTES,
+    WORKSPACE_RAM_MAX_BYTES, WORKSPACE_SIZE_FACTOR,
+)
+from service.metrics import inc
+
+
+WORKSPACE_DISK_DIR = os.path.join(CACHE_DIR, 'work')
+WORKSPACE_CHECK_SEC = 2.0
+
+# сколько байт папка зарезервировала в памяти, чтобы соседние задачи учитывали её рост
+RESERVED_FILE = '.reserved'
+
+_create_lock = threading.Lock()
+
+
+class WorkspaceQuotaError(Exception):
+    pass
+
+
+class WorkspaceRamExceeded(WorkspaceQuotaError):
+    # папка в памяти выросла больше лимитов для tmpfs, задачу нужно повторить на диске
+    pass
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                try:
+                    total += os.path.getsize(file_path)
+                except OSError:
+                    pass
+    return total
+
+
+def _reserved(path: str) -> int:
+    try:
+        with open(os.path.join(path, RESERVED_FILE), 'r') as f:
+            return int(f.read() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def _ram_usage() -> int:
+    # занятое папками в памяти: у каждой берётся большее из резерва и фактического размера
+    if not os.path.isdir(WORKSPACE_RAM_DIR):
+        return 0
+    total = 0
+    for entry in os.scandir(WORKSPACE_RAM_DIR):
+        if entry.is_dir():
+            total += max(_reserved(entry.path), _dir_size(entry.path))
+    return total
+
+
+def _fits_in_ram(estimate: int) -> bool:
+    if not WORKSPACE_RAM_DIR:
+        return False
+    mount = os.path.dirname(os.path.normpath(WORKSPACE_RAM_DIR))
+    if not os.path.isdir(mount) or estimate > WORKSPACE_RAM_JOB_MAX_BYTES:
+        return False
+    if _ram_usage() + estimate > WORKSPACE_RAM_MAX_BYTES:
+        return False
+    return shutil.disk_usage(mount).free > estimate
+
+
+class Workspace:
+    def __init__(self, job_id: int, path: str, in_ram: bool):
+        self.job_id = job_id
+        self.path = path
+        self.in_ram = in_ram
+
+    def link_source(self, video_path: str) -> str:
+        # промежуточные файлы пишутся рядом с исходником, поэтому исходник кладём в папку задачи;
+        # символическая ссылка работает и между файловыми системами, иначе жёсткая ссылка или копия
+        source = os.path.join(self.path, os.path.basename(video_path))
+        if os.path.lexists(source):
+            # папка осталась от прошлой попытки вместе со ссылкой
+            return source
+        try:
+            os.symlink(os.path.abspath(video_path), source)
+        except OSError:
+            link_or_copy(video_path, source)
+        return source
+
+    def usage(self) -> int:
+        return _dir_size(self.path)
+
+    async def run(self, coro):
+        """
+        Выполняет задачу и следит за размером папки.
+
+        Если папка выросла больше WORKSPACE_JOB_MAX_BYTES, задача отменяется (вместе с её ffmpeg)
+        и поднимается WorkspaceQuotaError. Папка в памяти, вышедшая за WORKSPACE_RAM_JOB_MAX_BYTES
+        или вместе с остальными за WORKSPACE_RAM_MAX_BYTES, поднимает WorkspaceRamExceeded.
+        """
+        task = asyncio.ensure_future(coro)
+        watcher = asyncio.create_task(self._watch())
+        try:
+            done, _ = await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if watcher in done:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                watcher.result()
+            return task.result()
+        finally:
+            task.cancel()
+            watcher.cancel()
+            # ждём остановки ffmpeg, иначе он продолжит писать в удаляемую папку
+            await asyncio.gather(task, watcher, return_exceptions=True)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(WORKSPACE_CHECK_SEC)
+            usage = await asyncio.to_thread(self.usage)
+            if usage > WORKSPACE_JOB_MAX_BYTES:
+                inc('workspace_quota_exceeded_total')
+                raise WorkspaceQuotaError(
+                    f'промежуточные файлы задачи заняли {usage // (1024 * 1024)} МБ, '
+                    f'лимит {WORKSPACE_JOB_MAX_BYTES // (1024 * 1024)} МБ'
+                )
+            if self.in_ram and (
+                usage > WORKSPACE_RAM_JOB_MAX_BYTES
+                or await asyncio.to_thread(_ram_usage) > WORKSPACE_RAM_MAX_BYTES
+            ):
+                inc('workspace_ram_exceeded_total')
+                raise WorkspaceRamExceeded(f'рабочая папка задачи {self.job_id} не помещается в памяти')
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def create_workspace(job_id: int, video_path: str, prefer_ram: bool = True) -> Workspace:
+    # по оценке задача занимает несколько размеров исходника: части, эффекты, результат
+    source_size = os.path.getsize(video_path) if os.path.exists(video_path) else 0
+    estimate = int(source_size * WORKSPACE_SIZE_FACTOR)
+
+    with _create_lock:
+        # папка могла остаться от прошлой попытки этой задачи, в памяти или на диске
+        for root in (WORKSPACE_RAM_DIR, WORKSPACE_DISK_DIR):
+            if root:
+                shutil.rmtree(os.path.join(root, f'job_{job_id}'), ignore_errors=True)
+
+        in_ram = prefer_ram and _fits_in_ram(estimate)
+        path = os.path.join(WORKSPACE_RAM_DIR if in_ram else WORKSPACE_DISK_DIR, f'job_{job_id}')
+        os.makedirs(path)
+        if in_ram:
+            with open(os.path.join(path, RESERVED_FILE), 'w') as f:
+                f.write(str(estimate))
+
+    inc('workspaces_total', storage='ram' if in_ram else 'disk')
+    return Workspace(job_id, path, in_ram)
+
+
+def find_workspace(job_id: int) -> Workspace | None:
+    # папка задачи от прошлой попытки: в ней может лежать уже готовый результат
+    for root, in_ram in ((WORKSPACE_RAM_DIR, True), (WORKSPACE_DISK_DIR, False)):
+        path = os.path.join(root, f'job_{job_id}') if root else None
+        if path and os.path.isdir(path):
+            return Workspace(job_id, path, in_ram)
+    return None
+
+
+def sweep_workspaces(active_job_ids: set) -> int:
+    """
+    Удаляет папки задач, которые уже завершены (остались после падения процесса).
+
+    Returns:
+        Сколько папок удалено
+    """
+    removed = 0
+    for root in (WORKSPACE_RAM_DIR, WORKSPACE_DISK_DIR):
+        if not root or not os.path.isdir(root):
+            continue
+        for entry in os.scandir(root):
+            name = entry.name
+            if not entry.is_dir() or not name.startswith('job_') or not name[4:].isdigit():
+                continue
+            if int(name[4:]) not in active_job_ids:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+    return removed
@@ -0,0 +1,142 @@
+"""
+Работа с локальным сервером Bot API (telegram-bot-api --local) через подставной aiohttp-сервер.
+
+Подставной сервер отвечает на getFile путём к файлу на «своём» диске и запоминает, что пришло
+в sendVideo. Проверяется, что исходник не скачивается по HTTP, а берётся жёсткой ссылкой
+из общей папки, и что результат отправляется путём file://, а не загрузкой файла.
+"""
+import asyncio
+import os
+
+from aiogram.types import FSInputFile
+from aiohttp import web
+
+from service import telegram
+
+
+TOKEN = '42:TEST'
+# так общую папку видит сервер (например, внутри контейнера)
+SERVER_FILES_DIR = '/var/lib/telegram-bot-api'
+
+
+async def _start_api(received: dict, file_path: str):
+    async def get_file(request):
+        return web.json_response({
+            'ok': True,
+            'result': {'file_id': 'video', 'file_unique_id': 'unique', 'file_path': file_path},
+        })
+
+    async def send_video(request):
+        received.update(await request.post())
+        return web.json_response({
+            'ok': True,
+            'result': {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}},
+        })
+
+    app = web.Application()
+    app.router.add_post(f'/bot{TOKEN}/getFile', get_file)
+    app.router.add_post(f'/bot{TOKEN}/sendVideo', send_video)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}'
+
+
+def _create_bot(monkeypatch, api_url: str, local_dir: str):
+    monkeypatch.setenv('TOKEN', TOKEN)
+    monkeypatch.setattr(telegram, 'BOT_API_URL', api_url)
+    monkeypatch.setattr(telegram, 'BOT_API_SERVER_FILES_DIR', SERVER_FILES_DIR)
+    monkeypatch.setattr(telegram, 'BOT_API_LOCAL_FILES_DIR', local_dir)
+    return telegram.create_bot()
+
+
+def test_fetch_video_links_local_file(tmp_path, monkeypatch):
+    local_dir = tmp_path / 'bot-api'
+    (local_dir / 'videos').mkdir(parents=True)
+    source = local_dir / 'videos' / 'file_1.mp4'
+    source.write_bytes(b'video')
+    destination = tmp_path / 'source.mp4'
+
+    async def run():
+        runner, api_url = await _start_api({}, f'{SERVER_FILES_DIR}/videos/file_1.mp4')
+        bot = _create_bot(monkeypatch, api_url, str(local_dir))
+        try:
+            await telegram.fetch_video(bot, 'video', str(destination))
+        finally:
+            await bot.session.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+    # жёсткая ссылка на файл сервера, а не скачанная копия
+    assert os.path.samefile(source, destination)
+
+
+def test_upload_file_sends_server_path(tmp_path, monkeypatch):
+    local_dir = tmp_path / 'bot-api'
+    local_dir.mkdir()
+    result = local_dir / 'result.mp4'
+    result.write_bytes(b'video')
+    received = {}
+
+    async def run():
+        runner, api_url = await _start_api(received, '')
+        bot = _create_bot(monkeypatch, api_url, str(local_dir))
+        try:
+            await bot.send_video(1, telegram.upload_file(bot, str(result)))
+        finally:
+            await bot.session.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+    assert received['video'] == f'file://{SERVER_FILES_DIR}/result.mp4'
+
+
+def test_upload_file_outside_shared_dir(tmp_path, monkeypatch):
+    local_dir = tmp_path / 'bot-api'
+    local_dir.mkdir()
+    result = tmp_path / 'work' / 'result.mp4'
+    result.parent.mkdir()
+    result.write_bytes(b'video')
+
+    async def run():
+        bot = _create_bot(monkeypatch, 'http://127.0.0.1:1', str(local_dir))
+        try:
+            return telegram.upload_file(bot, str(result))
+        finally:
+            await bot.session.close()
+
+    # файл вне общей папки сервер не увидит, он отправляется загрузкой
+    upload = asyncio.run(run())
+    assert isinstance(upload, FSInputFile) and str(upload.path) == str(result)
+
+
+def test_video_upload_shares_workspace_file(tmp_path, monkeypatch):
+    local_dir = tmp_path / 'bot-api'
+    local_dir.mkdir()
+    result = tmp_path / 'work' / 'result.mp4'
+    result.parent.mkdir()
+    result.write_bytes(b'video')
+    received = {}
+
+    async def run():
+        runner, api_url = await _start_api(received, '')
+        bot = _create_bot(monkeypatch, api_url, str(local_dir))
+        try:
+            async with telegram.video_upload(bot, str(result)) as upload:
+                await bot.send_video(1, upload)
+        finally:
+            await bot.session.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+    # файл из рабочей папки уходит путём через общую папку, копия после отправки удалена
+    assert received['video'].startswith(f'file://{SERVER_FILES_DIR}/uploads/')
+    assert received['video'].endswith('_result.mp4')
+    assert os.listdir(local_dir / 'uploads') == []
+    assert result.exists()